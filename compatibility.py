@@ -0,0 +1,35 @@
+"""
+Optional standard library modules, which some interpreter builds leave out.
+"""
+try:
+    import gzip
+except ImportError:  # pragma: no cover - interpreter built without zlib
+    gzip = None
+
+try:
+    import bz2
+except ImportError:  # pragma: no cover - interpreter built without libbz2
+    bz2 = None
+
+try:
+    import lzma
+except ImportError:  # pragma: no cover - interpreter built without liblzma
+    lzma = None
+
+try:
+    import sqlite3
+except ImportError:  # pragma: no cover - interpreter built without libsqlite3
+    sqlite3 = None
+
+import sys
+
+# ProcessPoolExecutor(max_tasks_per_child=...) appeared in Python 3.11.
+PROCESS_POOL_RECYCLING = sys.version_info >= (3, 11)
+
+# SharedMemory(track=...) appeared in Python 3.13; before, every process that
+# creates or attaches a segment registers it with its resource tracker.
+SHARED_MEMORY_TRACK = sys.version_info >= (3, 13)
+
+# Free-threaded builds (3.13t and later) can run without the GIL, in which case
+# threads run CPU-bound Python code in parallel.
+FREE_THREADING = hasattr(sys, "_is_gil_enabled") and not sys._is_gil_enabled()
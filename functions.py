@@ -1,8 +1,50 @@
 """
 
 """
+import asyncio
+import bisect
+import codecs
+import collections
+import concurrent.futures
+import copy
+import functools
+import inspect
+import io
 import itertools
-from typing import Iterable, List
+import locale
+import operator
+import os
+import pickle
+import queue
+import random
+import re
+import tempfile
+import threading
+import time
+from typing import Any, AsyncIterable, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import transport
+from compatibility import bz2, gzip, lzma, sqlite3
+
+# Headers of the compressed formats Stream.file decompresses transparently. A bzip2
+# stream starts with "BZh", its block size digit, then the magic of its first block
+# or, when empty, of its end, so that text merely starting with "BZh" is not taken
+# for it.
+_COMPRESSIONS = (
+    (re.compile(b"\x1f\x8b"), "gzip", gzip),
+    (re.compile(b"BZh[1-9](?:1AY&SY|\x17rE8P\x90)"), "bz2", bz2),
+    (re.compile(b"\xfd7zXZ\x00"), "lzma", lzma),
+)
+
+# The number of bytes to read to recognize any of the compressed formats.
+_SNIFF_SIZE = 10
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, exception: BaseException) -> None:
+        self.exception = exception
 
 
 def _chunk(iterable: Iterable, chunk_size: int) -> Iterable:
@@ -19,3 +61,1090 @@ def _compact(iterable: Iterable) -> Iterable:
 
 def _chainer(*iterable: Iterable) -> Iterable:
     return itertools.chain(*iterable)
+
+
+def _sniff_compression(head: bytes) -> Any:
+    if not isinstance(head, bytes):
+        return None
+    for magic, name, module in _COMPRESSIONS:
+        if magic.match(head):
+            if module is None:
+                raise ImportError(f"the {name} module is required to read this file")
+            return module
+    return None
+
+
+def _read_batches(opener: Callable, path: Any, batch_bytes: int = 1 << 16) -> Iterable:
+    with opener(path, "rt") as file:
+        while lines := file.readlines(batch_bytes):
+            yield lines
+
+
+def _put(buffer: queue.Queue, item: Any, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            buffer.put(item, timeout=0.05)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _pump(iterable: Iterable, buffer: queue.Queue, stop: threading.Event) -> None:
+    iterator = iter(iterable)
+    try:
+        for item in iterator:
+            if not _put(buffer, item, stop):
+                return
+        _put(buffer, _END, stop)
+    except BaseException as exception:
+        _put(buffer, _Failure(exception), stop)
+    finally:
+        if hasattr(iterator, "close"):
+            iterator.close()
+
+
+def _start_pump(iterable: Iterable, buffer_size: int, stop: threading.Event) -> queue.Queue:
+    buffer = queue.Queue(buffer_size)
+    threading.Thread(target=_pump, args=(iterable, buffer, stop), daemon=True).start()
+    return buffer
+
+
+def _drain(buffer: queue.Queue) -> Iterable:
+    while (item := buffer.get()) is not _END:
+        if isinstance(item, _Failure):
+            raise item.exception
+        yield item
+
+
+def _background(iterable: Iterable, buffer_size: int) -> Iterable:
+    if buffer_size < 1:
+        raise ValueError('buffer_size must be at least one')
+
+    stop = threading.Event()
+    try:
+        yield from _drain(_start_pump(iterable, buffer_size, stop))
+    finally:
+        stop.set()
+
+
+class _SharedSource:
+    def __init__(self, iterable: Iterable, batch_size: int) -> None:
+        self.iterator = iter(iterable)
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.exhausted = False
+
+    def take(self) -> List:
+        # One lock acquisition hands out a whole batch, and a short batch means
+        # the source is exhausted, so later calls return without touching it.
+        with self.lock:
+            if self.exhausted:
+                return []
+            try:
+                batch = list(itertools.islice(self.iterator, self.batch_size))
+            except BaseException:
+                self.exhausted = True
+                raise
+            if len(batch) < self.batch_size:
+                self.exhausted = True
+            return batch
+
+
+def _shared_view(source: _SharedSource) -> Iterable:
+    while batch := source.take():
+        yield from batch
+
+
+def _timed_chunk(iterable: Iterable, chunk_size: int, max_wait: float) -> Iterable:
+    if chunk_size < 1:
+        raise ValueError('chunk_size must be at least one')
+    if max_wait <= 0:
+        raise ValueError('max_wait must be positive')
+
+    # The source is pulled on a background thread, so that a batch can be flushed
+    # at its deadline while the source is still waiting for its next item.
+    stop = threading.Event()
+    buffer = _start_pump(iterable, chunk_size, stop)
+    try:
+        while (item := buffer.get()) is not _END:
+            batch = []
+            deadline = time.monotonic() + max_wait
+            while True:
+                if isinstance(item, _Failure):
+                    raise item.exception
+                batch.append(item)
+                remaining = deadline - time.monotonic()
+                if len(batch) == chunk_size or remaining <= 0:
+                    break
+                try:
+                    item = buffer.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _END:
+                    break
+            yield batch
+            if item is _END:
+                return
+    finally:
+        stop.set()
+
+
+def _follow(path: Any, poll_interval: float, chunk_size: int = 1 << 16) -> Iterable:
+    # Data is read in bulk chunks and split into lines, a trailing partial line is
+    # kept until its end is written. At the end of the file, checks start a few
+    # milliseconds apart and back off to 'poll_interval' while nothing is written.
+    encoding = locale.getpreferredencoding(False)
+    interval = minimum = min(0.005, poll_interval)
+    handle = open(path, "rb")
+    decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(encoding)(), True)
+    partial = ""
+    try:
+        while True:
+            data = handle.read(chunk_size)
+            if data:
+                lines = (partial + decoder.decode(data)).split("\n")
+                partial = lines.pop()
+                yield from (line + "\n" for line in lines)
+                interval = minimum
+                continue
+            try:
+                status = os.stat(path)
+            except FileNotFoundError:
+                status = None
+            current = os.fstat(handle.fileno())
+            if status is not None and (status.st_ino, status.st_dev) != (current.st_ino, current.st_dev):
+                # Rotated: the old file is read to its end, then the new one from its start.
+                if partial:
+                    yield partial
+                handle.close()
+                handle = open(path, "rb")
+                decoder.reset()
+                partial = ""
+                continue
+            if status is not None and status.st_size < handle.tell():
+                # Truncated: the file is read again from its start.
+                handle.seek(0)
+                decoder.reset()
+                partial = ""
+                continue
+            time.sleep(interval)
+            interval = min(interval * 2, poll_interval)
+    finally:
+        handle.close()
+
+
+# Encodings in which b"\r" and b"\n" bytes are always line breaks, so that a file
+# can be split into lines from any position.
+_SPLITTABLE_ENCODINGS = {"ascii", "utf-8", "iso8859-1", "cp1252"}
+
+# Line breaks of universal newlines, as read by files opened in text mode.
+_LINE_BREAK = re.compile(b"\r\n|\r|\n")
+
+
+def _decode_line(line: bytes, encoding: str) -> str:
+    if line.endswith(b"\r\n"):
+        line = line[:-2] + b"\n"
+    elif line.endswith(b"\r"):
+        line = line[:-1] + b"\n"
+    return line.decode(encoding)
+
+
+def _reversed_lines(path: Any, encoding: str, block_size: int = 1 << 16) -> Iterable:
+    # Blocks are read from the end of the file; 'pending' holds the start of the
+    # buffer up to its first certain line break, which belongs to a line starting
+    # in an earlier block. A break at the very start of the buffer may be the "\n"
+    # of a "\r\n" split between blocks, so it is not trusted until the earlier
+    # block is read.
+    with open(path, "rb") as handle:
+        position = handle.seek(0, os.SEEK_END)
+        pending = b""
+        while position > 0:
+            step = min(block_size, position)
+            position -= step
+            handle.seek(position)
+            buffer = handle.read(step) + pending
+            starts = [
+                match.end()
+                for match in _LINE_BREAK.finditer(buffer)
+                if position == 0 or match.start() > 0
+            ]
+            if position == 0:
+                starts.insert(0, 0)
+            elif not starts:
+                pending = buffer
+                continue
+            pending = buffer[: starts[0]]
+            for start, end in reversed(list(zip(starts, starts[1:] + [len(buffer)]))):
+                if start < end:
+                    yield _decode_line(buffer[start:end], encoding)
+
+
+def _count_lines(path: Any, block_size: int = 1 << 20) -> int:
+    # Universal newlines end a line on "\r\n", "\r" or "\n", a "\r\n" split
+    # between two blocks counting once.
+    count = 0
+    previous = b""
+    with open(path, "rb") as handle:
+        while data := handle.read(block_size):
+            count += data.count(b"\n") + data.count(b"\r") - data.count(b"\r\n")
+            if previous.endswith(b"\r") and data.startswith(b"\n"):
+                count -= 1
+            previous = data
+    return count + (1 if previous and not previous.endswith((b"\r", b"\n")) else 0)
+
+
+def _drop_last(iterable: Iterable, count: int) -> Iterable:
+    delayed = collections.deque()
+    for item in iterable:
+        delayed.append(item)
+        if len(delayed) > count:
+            yield delayed.popleft()
+
+
+def _file_batches(path: Any, with_path: bool) -> Iterable:
+    with open(path, "rb") as handle:
+        module = _sniff_compression(handle.read(_SNIFF_SIZE))
+    for lines in _read_batches(open if module is None else module.open, path):
+        yield [(path, line) for line in lines] if with_path else lines
+
+
+def _concat_files(paths: Iterable, max_open: int, with_path: bool, buffer_size: int) -> Iterable:
+    if max_open < 1:
+        raise ValueError('max_open must be at least one')
+
+    paths = iter(paths)
+    stop = threading.Event()
+    readers = collections.deque()
+    try:
+        for path in itertools.islice(paths, max_open):
+            readers.append(_start_pump(_file_batches(path, with_path), buffer_size, stop))
+        while readers:
+            yield from itertools.chain.from_iterable(_drain(readers.popleft()))
+            for path in itertools.islice(paths, 1):
+                readers.append(_start_pump(_file_batches(path, with_path), buffer_size, stop))
+    finally:
+        stop.set()
+
+
+def _interleave_files(paths: Iterable, max_open: int, with_path: bool, buffer_size: int) -> Iterable:
+    if max_open < 1:
+        raise ValueError('max_open must be at least one')
+
+    paths = iter(paths)
+    stop = threading.Event()
+    buffer = queue.Queue(buffer_size)
+    active = 0
+
+    def start(path):
+        threading.Thread(
+            target=_pump, args=(_file_batches(path, with_path), buffer, stop), daemon=True
+        ).start()
+
+    try:
+        for path in itertools.islice(paths, max_open):
+            start(path)
+            active += 1
+        while active:
+            item = buffer.get()
+            if item is _END:
+                active -= 1
+                for path in itertools.islice(paths, 1):
+                    start(path)
+                    active += 1
+            elif isinstance(item, _Failure):
+                raise item.exception
+            else:
+                yield from item
+    finally:
+        stop.set()
+
+
+def _spill(file: Any, key: Any, item: Any) -> None:
+    pickle.dump((key, item), file, pickle.HIGHEST_PROTOCOL)
+
+
+def _unspill(file: Any) -> Iterable:
+    file.seek(0)
+    while True:
+        try:
+            yield pickle.load(file)
+        except EOFError:
+            return
+
+
+def _probe(table: dict, probe: Iterable, outer: bool) -> Iterable:
+    for key, item in probe:
+        matches = table.get(key)
+        if matches:
+            for match in matches:
+                yield item, match
+        elif outer:
+            yield item, None
+
+
+# Depth after which an oversized partition is joined in memory anyway, since its
+# items most likely share a handful of keys that no hash can split.
+_MAX_JOIN_DEPTH = 4
+
+
+def _partition(pairs: Iterable, partitions: int, depth: int) -> Tuple[List, List[int]]:
+    # Each depth salts the hash, so that the keys of one partition spread over the
+    # partitions of the next depth.
+    files = [tempfile.TemporaryFile() for _ in range(partitions)]
+    counts = [0] * partitions
+    try:
+        for key, item in pairs:
+            index = (hash(key) if depth == 0 else hash((depth, key))) % partitions
+            _spill(files[index], key, item)
+            counts[index] += 1
+    except BaseException:
+        for file in files:
+            file.close()
+        raise
+    return files, counts
+
+
+def _join_partitions(
+    left_pairs: Iterable,
+    right_pairs: Iterable,
+    outer: bool,
+    max_build_size: int,
+    partitions: int,
+    depth: int,
+) -> Iterable:
+    # The right side is partitioned first, so that the items of the right side
+    # already read are released before the left side is read.
+    right_files, right_counts = _partition(right_pairs, partitions, depth)
+    try:
+        left_files, left_counts = _partition(left_pairs, partitions, depth)
+    except BaseException:
+        for file in right_files:
+            file.close()
+        raise
+    try:
+        for index in range(partitions):
+            yield from _join_partition(
+                left_files[index],
+                right_files[index],
+                left_counts[index],
+                right_counts[index],
+                outer,
+                max_build_size,
+                depth,
+            )
+            left_files[index].close()
+            right_files[index].close()
+    finally:
+        for file in left_files + right_files:
+            file.close()
+
+
+def _join_partition(
+    left_file: Any,
+    right_file: Any,
+    left_count: int,
+    right_count: int,
+    outer: bool,
+    max_build_size: int,
+    depth: int,
+) -> Iterable:
+    build_count = min(left_count, right_count)
+    if build_count > max_build_size and depth < _MAX_JOIN_DEPTH:
+        # Still too large to build in memory: partition again, into as many
+        # partitions as needed for each one to fit, with some slack for skew.
+        partitions = min(256, 2 * -(-build_count // max_build_size))
+        yield from _join_partitions(
+            _unspill(left_file), _unspill(right_file), outer, max_build_size, partitions, depth + 1
+        )
+        return
+    # Build on the smaller side; a left join building on the left side reports
+    # the left items no right item matched once the probe is over.
+    if left_count < right_count:
+        table = collections.defaultdict(list)
+        for key, item in _unspill(left_file):
+            table[key].append(item)
+        matched = set()
+        for key, item in _unspill(right_file):
+            if key in table:
+                matched.add(key)
+                for match in table[key]:
+                    yield match, item
+        if outer:
+            for key in table.keys() - matched:
+                for item in table[key]:
+                    yield item, None
+    else:
+        table = collections.defaultdict(list)
+        for key, item in _unspill(right_file):
+            table[key].append(item)
+        yield from _probe(table, _unspill(left_file), outer)
+
+
+def _hash_join(
+    left: Iterable,
+    right: Iterable,
+    left_key: Callable,
+    right_key: Callable,
+    outer: bool,
+    max_build_size: int,
+    partitions: int = 16,
+) -> Iterable:
+    table = collections.defaultdict(list)
+    right = iter(right)
+    size = 0
+    for item in right:
+        table[right_key(item)].append(item)
+        size += 1
+        if size > max_build_size:
+            break
+    else:
+        yield from _probe(table, ((left_key(item), item) for item in left), outer)
+        return
+
+    # The build side does not fit in memory: partition both sides on disk by key
+    # hash, then join the partitions one by one.
+    spilled = itertools.chain(
+        ((key, item) for key, items in table.items() for item in items),
+        ((right_key(item), item) for item in right),
+    )
+    table = None
+    yield from _join_partitions(
+        ((left_key(item), item) for item in left), spilled, outer, max_build_size, partitions, 0
+    )
+
+
+def _merge_join(left: Iterable, right: Iterable, left_key: Callable, right_key: Callable, outer: bool) -> Iterable:
+    groups = itertools.groupby(right, key=right_key)
+    group = next(groups, None)
+    matches = list(group[1]) if group else []
+    for item in left:
+        key = left_key(item)
+        while group is not None and group[0] < key:
+            group = next(groups, None)
+            matches = list(group[1]) if group else []
+        if group is not None and group[0] == key:
+            for match in matches:
+                yield item, match
+        elif outer:
+            yield item, None
+
+
+def _reduce_batch(reducer: Any, batch: List) -> List:
+    function, initial = reducer
+    if initial is None:
+        return [functools.reduce(function, batch)]
+    return [functools.reduce(function, batch, copy.copy(initial))]
+
+
+def _tree_reduce(combiner: Callable, partials: Iterable, initial: Any) -> Any:
+    # levels[i] holds the combination of 2**i consecutive partials, earlier partials
+    # sit on higher levels, so the order of the partials is kept.
+    levels = []
+    for partial in partials:
+        for index, level in enumerate(levels):
+            if level is _END:
+                levels[index] = partial
+                break
+            partial = combiner(level, partial)
+            levels[index] = _END
+        else:
+            levels.append(partial)
+    result = _END
+    for level in reversed(levels):
+        if level is not _END:
+            result = level if result is _END else combiner(result, level)
+    if result is not _END:
+        return result
+    if initial is None:
+        raise TypeError("reduce() of empty iterable with no initial value")
+    return initial
+
+
+def _increment(count: int, item: Any) -> int:
+    return count + 1
+
+
+def _aggregate_batch(aggregator: Any, batch: Iterable) -> List:
+    key_function, function, initial = aggregator
+    partial = {}
+    for item in batch:
+        key = key_function(item)
+        partial[key] = function(partial[key] if key in partial else copy.copy(initial), item)
+    return [partial]
+
+
+def _split_aggregate_batch(aggregator: Any, batch: Iterable) -> List:
+    # The partial of the batch comes back split by key hash, so that the caller only
+    # routes each part to the merge of its partition.
+    key_function, function, initial, partitions = aggregator
+    parts = [{} for _ in range(partitions)]
+    for key, value in _aggregate_batch((key_function, function, initial), batch)[0].items():
+        parts[hash(key) % partitions][key] = value
+    return [parts]
+
+
+def _group_batch(key_function: Callable, batch: Iterable) -> List:
+    partial = {}
+    for item in batch:
+        partial.setdefault(key_function(item), []).append(item)
+    return [partial]
+
+
+def _merge_partials(combiner: Callable, partials: List[Dict]) -> Dict:
+    merged = {}
+    for partial in partials:
+        for key, value in partial.items():
+            merged[key] = combiner(merged[key], value) if key in merged else value
+    return merged
+
+
+def _resolve(value: Any) -> Any:
+    return value.result() if isinstance(value, concurrent.futures.Future) else value
+
+
+def _partitioned_merge(pool: Any, combiner: Callable, partials: Iterable, partitions: int) -> Dict:
+    # Each partial is a list of parts, one per partition, and each partition is merged
+    # by one task; a partition holding too many parts is compacted by a merge in the
+    # meantime.
+    buckets = [[] for _ in range(partitions)]
+    for parts in partials:
+        for bucket, part in zip(buckets, parts):
+            if part:
+                bucket.append(part)
+                if len(bucket) > 2 * partitions:
+                    bucket[:] = [
+                        pool.submit(_merge_partials, combiner, [_resolve(p) for p in bucket])
+                    ]
+    futures = [
+        pool.submit(_merge_partials, combiner, [_resolve(p) for p in bucket])
+        for bucket in buckets
+        if bucket
+    ]
+    # Processes started without fork may hash keys differently, in which case a key
+    # can show up in several partitions, so partitions are combined rather than updated.
+    return _merge_partials(combiner, (future.result() for future in futures))
+
+
+def _sort_batch(reverse: bool, pairs: List) -> List:
+    pairs.sort(key=operator.itemgetter(0), reverse=reverse)
+    return [item for _, item in pairs]
+
+
+def _keyed_batch(key_function: Callable, batch: List) -> List:
+    return [(key_function(item), item) for item in batch]
+
+
+def _dedup_shard(seen: set, entries: List) -> List:
+    kept = []
+    for position, key in entries:
+        if key not in seen:
+            seen.add(key)
+            kept.append(position)
+    return kept
+
+
+def _unique(items: Iterable) -> Iterable:
+    seen = set()
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            yield item
+
+
+def _unique_pairs(pairs: Iterable) -> Iterable:
+    seen = set()
+    for key, item in pairs:
+        if key not in seen:
+            seen.add(key)
+            yield item
+
+
+def _sharded_distinct(pairs: Iterable, lanes: List, batch_size: int, window: int, ordered: bool) -> Iterable:
+    # Each shard owns the keys whose hash falls in it and is served by a single
+    # lane, so its tasks run in submission order without locking and the first
+    # occurrence of a key is always the one kept.
+    shards = len(lanes)
+    seen = [set() for _ in range(shards)]
+    pending = collections.deque()
+
+    def emit(batch, futures):
+        if ordered:
+            positions = sorted(itertools.chain.from_iterable(f.result() for f in futures))
+        else:
+            positions = itertools.chain.from_iterable(
+                f.result() for f in concurrent.futures.as_completed(futures)
+            )
+        return [batch[position][1] for position in positions]
+
+    try:
+        for batch in _chunk(iter(pairs), batch_size):
+            routes = [[] for _ in range(shards)]
+            for position, (key, _) in enumerate(batch):
+                routes[hash(key) % shards].append((position, key))
+            futures = [
+                lanes[shard].submit(_dedup_shard, seen[shard], route)
+                for shard, route in enumerate(routes)
+                if route
+            ]
+            pending.append((batch, futures))
+            if len(pending) >= window:
+                yield from emit(*pending.popleft())
+        while pending:
+            yield from emit(*pending.popleft())
+    finally:
+        # Lanes are shared: tasks of abandoned batches are cancelled, not waited for.
+        for _, futures in pending:
+            for future in futures:
+                future.cancel()
+
+
+def _map_batch(function: Callable, batch: List) -> List:
+    return [function(item) for item in batch]
+
+
+def _filter_batch(predicate: Callable, batch: List) -> List:
+    return [item for item in batch if predicate(item)]
+
+
+def _exclude_batch(predicate: Callable, batch: List) -> List:
+    return [item for item in batch if not predicate(item)]
+
+
+class _BatchTuner:
+    """
+    Choose the size of the batches of a parallel stage.
+
+    With a fixed size, batches always hold that many items. Otherwise the tuner
+    measures the compute cost of an item in the workers and the fixed cost of a
+    task (dispatch, serialization and transfer, estimated by the fastest round trip
+    minus its compute time), and sizes batches so that a task lasts about 'target'
+    seconds, or ten times its fixed cost when that is longer.
+    """
+
+    def __init__(
+        self,
+        fixed: Optional[int] = None,
+        target: float = 0.02,
+        initial: int = 8,
+        maximum: int = 1 << 16,
+    ) -> None:
+        self.fixed = fixed
+        self.target = target
+        self.maximum = maximum
+        self.size = fixed or initial
+        self.sizes = [self.size]
+        self.item_cost = None
+        self.task_overhead = None
+        self.tasks = 0
+
+    def observe(self, count: int, elapsed: float, roundtrip: float) -> None:
+        self.tasks += 1
+        cost = elapsed / count
+        overhead = max(roundtrip - elapsed, 0.0)
+        if self.item_cost is None:
+            self.item_cost, self.task_overhead = cost, overhead
+        else:
+            self.item_cost = 0.8 * self.item_cost + 0.2 * cost
+            self.task_overhead = min(self.task_overhead, overhead)
+        if self.fixed is not None:
+            return
+        duration = max(self.target, 10 * self.task_overhead)
+        desired = int(duration / self.item_cost) if self.item_cost > 0 else self.maximum
+        # Grow at most four times per task so that one noisy measure cannot blow up
+        # the batches of a stage.
+        self.size = max(1, min(self.maximum, desired, 4 * self.size))
+        if self.size != self.sizes[-1]:
+            self.sizes.append(self.size)
+
+    def profile(self) -> Dict[str, Any]:
+        return {
+            "batch_size": self.size,
+            "batch_sizes": list(self.sizes),
+            "item_cost": self.item_cost,
+            "task_overhead": self.task_overhead,
+            "tasks": self.tasks,
+        }
+
+
+def _timed(task: Callable, function: Callable, batch: List) -> Any:
+    started = time.perf_counter()
+    results = task(function, batch)
+    return results, time.perf_counter() - started
+
+
+def _stamp(future: concurrent.futures.Future) -> None:
+    future.completed_at = time.perf_counter()
+
+
+def _parallel(
+    pool: Any,
+    task: Callable,
+    function: Callable,
+    iterable: Iterable,
+    tuner: _BatchTuner,
+    window: int,
+    ordered: bool = True,
+    shared_memory: Optional[int] = None,
+) -> Iterable:
+    # At most 'window' batches are in flight or waiting to be yielded, so an
+    # unbounded source is never submitted to the pool as a whole and a slow batch
+    # holds back at most 'window' batches in ordered mode.
+    iterator = iter(iterable)
+
+    def submit(count):
+        futures = []
+        for _ in range(count):
+            batch = list(itertools.islice(iterator, tuner.size))
+            if not batch:
+                break
+            submitted_at = time.perf_counter()
+            if shared_memory is None:
+                future = pool.submit(_timed, task, function, batch)
+            else:
+                payload, segment = transport.share(batch, shared_memory)
+                future = pool.submit(
+                    _timed, transport.run_shared, (task, function, shared_memory), payload
+                )
+                if segment is not None:
+                    future.add_done_callback(functools.partial(transport.release, segment))
+            future.count = len(batch)
+            future.submitted_at = submitted_at
+            future.add_done_callback(_stamp)
+            futures.append(future)
+        return futures
+
+    def collect(future):
+        results, elapsed = future.result()
+        results = transport.unshare(results)
+        # Waiters wake up before done callbacks run, so the stamp may not be there yet.
+        completed_at = getattr(future, "completed_at", None) or time.perf_counter()
+        tuner.observe(future.count, elapsed, completed_at - future.submitted_at)
+        return results
+
+    # When the consumer stops early, raises, or drops the Stream, the batches not
+    # started yet are cancelled instead of being computed for nothing.
+    pending = collections.deque(submit(window)) if ordered else set(submit(window))
+    try:
+        if ordered:
+            while pending:
+                results = collect(pending.popleft())
+                pending.extend(submit(1))
+                yield from results
+        else:
+            while pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                results = [collect(future) for future in done]
+                pending.update(submit(len(done)))
+                yield from itertools.chain.from_iterable(results)
+    finally:
+        for future in pending:
+            if not future.cancel() and shared_memory is not None:
+                # Results shared back by a worker are only released when collected,
+                # so those of batches done or still running are released here.
+                future.add_done_callback(_discard_results)
+
+
+def _discard_results(future: concurrent.futures.Future) -> None:
+    if not future.cancelled() and future.exception() is None:
+        transport.discard(future.result()[0])
+
+
+def _sample_sort(
+    pool: Any,
+    items: List,
+    key: Optional[Callable],
+    reverse: bool,
+    partitions: int,
+    window: int,
+    ship: Callable = lambda function: function,
+) -> List:
+    if len(items) < 64 * partitions:
+        return sorted(items, key=key, reverse=reverse)
+
+    keys = items
+    if key is not None:
+        keys = list(_parallel(pool, _map_batch, ship(key), items, _BatchTuner(), window))
+    # Splitters taken from a sorted sample route each item to a key range. Equal
+    # keys always land in the same range, and each range keeps the original order
+    # of its items, so the stable sort of the ranges gives a stable result.
+    sample = sorted(random.sample(keys, min(len(keys), 32 * partitions)))
+    splitters = [sample[index * len(sample) // partitions] for index in range(1, partitions)]
+    ranges = [[] for _ in range(partitions)]
+    for item_key, item in zip(keys, items):
+        ranges[bisect.bisect_right(splitters, item_key)].append((item_key, item))
+    if reverse:
+        ranges.reverse()
+    futures = [pool.submit(_sort_batch, reverse, pairs) for pairs in ranges if pairs]
+    return list(itertools.chain.from_iterable(future.result() for future in futures))
+
+
+def _call_started(function: Callable, started: queue.SimpleQueue, item: Any) -> Any:
+    started.put(time.monotonic())
+    return function(item)
+
+
+def _map_concurrent(
+    iterable: Iterable,
+    function: Callable,
+    max_in_flight: int,
+    timeout: Optional[float],
+    on_error: str,
+    errors: List,
+) -> Iterable:
+    # A dedicated pool, so that calls still running after their timeout only hold
+    # threads of this Stream. Such a call keeps its thread, so the pool is replaced
+    # by a fresh one for the following items, and the abandoned pool lets its
+    # threads go as their calls return. Every call in flight therefore has a thread,
+    # and its timeout counts from the moment it starts running.
+    def create_pool():
+        return concurrent.futures.ThreadPoolExecutor(max_in_flight, thread_name_prefix="streampy-io")
+
+    pool = create_pool()
+    iterator = iter(iterable)
+    pending = collections.deque()
+    try:
+        while True:
+            while len(pending) < max_in_flight:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                started = queue.SimpleQueue()
+                pending.append((item, started, pool.submit(_call_started, function, started, item)))
+            if not pending:
+                return
+            item, started, future = pending.popleft()
+            try:
+                if timeout is None:
+                    result = future.result()
+                else:
+                    result = future.result(max(0.0, started.get() + timeout - time.monotonic()))
+            except Exception as error:
+                if isinstance(error, concurrent.futures.TimeoutError) and not future.done():
+                    pool.shutdown(wait=False)
+                    pool = create_pool()
+                    error = TimeoutError(f"{item!r} not processed within {timeout} seconds")
+                if on_error == "raise":
+                    raise error
+                if on_error == "collect":
+                    errors.append((item, error))
+                continue
+            yield result
+    finally:
+        for _, _, future in pending:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+
+def _map_with_resource(
+    iterable: Iterable, function: Callable, factory: Callable, close: Callable, workers: Optional[int]
+) -> Iterable:
+    local = threading.local()
+    resources = []
+    lock = threading.Lock()
+
+    def call(item):
+        if not hasattr(local, "resource"):
+            local.resource = factory()
+            with lock:
+                resources.append(local.resource)
+        return function(local.resource, item)
+
+    pool = None
+    pending = collections.deque()
+    try:
+        if workers is None:
+            yield from map(call, iterable)
+            return
+        pool = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="streampy-resource")
+        for item in iterable:
+            pending.append(pool.submit(call, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # Calls still running use their resource, so they finish before any is closed.
+        if pool is not None:
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+        for resource in resources:
+            close(resource)
+
+
+def _close_resource(resource: Any) -> None:
+    closer = getattr(resource, "close", None)
+    if closer is not None:
+        closer()
+
+
+class CacheInfo(NamedTuple):
+    """
+    Statistics of the cache of a `Stream.memo_map`, returned by its `cache_info()`.
+    """
+
+    hits: int
+    misses: int
+    disk_hits: int
+    maxsize: int
+    currsize: int
+
+
+class _MemoCache:
+    def __init__(self, function: Callable, size: int, path: Any) -> None:
+        self.function = function
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = self.misses = self.disk_hits = 0
+        self.database = None
+        self.unsaved = 0
+        if path is not None:
+            if sqlite3 is None:
+                raise ImportError("the sqlite3 module is required for a persistent cache")
+            self.database = sqlite3.connect(str(path), check_same_thread=False)
+            self.database.execute("CREATE TABLE IF NOT EXISTS memo (key BLOB PRIMARY KEY, value BLOB)")
+
+    def __call__(self, item: Any) -> Any:
+        if item in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(item)
+            return self.entries[item]
+        key = None
+        if self.database is not None:
+            key = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+            row = self.database.execute("SELECT value FROM memo WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.hits += 1
+                self.disk_hits += 1
+                return self.remember(item, pickle.loads(row[0]))
+        self.misses += 1
+        value = self.function(item)
+        if key is not None:
+            self.database.execute(
+                "INSERT OR REPLACE INTO memo VALUES (?, ?)",
+                (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)),
+            )
+            # Commits are grouped, a transaction per value would bound the throughput.
+            self.unsaved += 1
+            if self.unsaved >= 256:
+                self.save()
+        return self.remember(item, value)
+
+    def remember(self, item: Any, value: Any) -> Any:
+        self.entries[item] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return value
+
+    def save(self) -> None:
+        if self.database is not None and self.unsaved:
+            self.database.commit()
+            self.unsaved = 0
+
+    def close(self) -> None:
+        if self.database is not None:
+            self.save()
+            self.database.close()
+            self.database = None
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.disk_hits, self.size, len(self.entries))
+
+
+def _memo_map(iterable: Iterable, cache: _MemoCache) -> Iterable:
+    try:
+        yield from map(cache, iterable)
+    finally:
+        cache.close()
+
+
+async def _asynchronous(iterable: Iterable) -> AsyncIterable:
+    for item in iterable:
+        yield item
+
+
+async def _acall(function: Callable, item: Any) -> Any:
+    result = function(item)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+async def _amap(iterable: AsyncIterable, function: Callable, max_concurrency: int, ordered: bool) -> AsyncIterable:
+    if max_concurrency < 1:
+        raise ValueError('max_concurrency must be at least one')
+
+    iterator = iterable.__aiter__()
+    pending = collections.deque() if ordered else set()
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < max_concurrency:
+                try:
+                    item = await iterator.__anext__()
+                except StopAsyncIteration:
+                    exhausted = True
+                else:
+                    task = asyncio.ensure_future(_acall(function, item))
+                    if ordered:
+                        pending.append(task)
+                    else:
+                        pending.add(task)
+            if not pending:
+                return
+            if ordered:
+                yield await pending.popleft()
+            else:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def _afilter(iterable: AsyncIterable, predicate: Callable) -> AsyncIterable:
+    async for item in iterable:
+        if await _acall(predicate, item):
+            yield item
+
+
+async def _achunk(iterable: AsyncIterable, chunk_size: int) -> AsyncIterable:
+    if chunk_size < 1:
+        raise ValueError('chunk_size must be at least one')
+
+    batch = []
+    async for item in iterable:
+        batch.append(item)
+        if len(batch) == chunk_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def _adistinct(iterable: AsyncIterable, key_function: Callable) -> AsyncIterable:
+    seen = set()
+    async for item in iterable:
+        key = key_function(item) if key_function else item
+        if key not in seen:
+            seen.add(key)
+            yield item
+
+
+async def _atake(iterable: AsyncIterable, count: int) -> AsyncIterable:
+    if count <= 0:
+        return
+    async for item in iterable:
+        yield item
+        count -= 1
+        if count == 0:
+            break
+    # Close the source now rather than on garbage collection, so that in-flight
+    # work upstream is cancelled as soon as enough items were taken.
+    if hasattr(iterable, "aclose"):
+        await iterable.aclose()
@@ -0,0 +1,194 @@
+"""
+Process-wide worker pools shared by every parallel Stream.
+
+Pools are created lazily on first use, keyed by kind, number of workers and slot,
+and reused by every later pipeline so that short-lived Streams do not pay the
+start-up cost of threads or processes. The slot is the position of a parallel stage
+in its pipeline, so that the stages of one pipeline never compete for the same
+workers. Pools are shut down when the interpreter exits.
+"""
+import atexit
+import importlib
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import resource_tracker
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+from compatibility import PROCESS_POOL_RECYCLING
+
+THREAD = "thread"
+PROCESS = "process"
+# A single thread running its tasks in submission order.
+LANE = "lane"
+
+_lock = threading.RLock()
+_pools: Dict[Tuple[str, int, int], Executor] = {}
+_modules: Tuple[str, ...] = ()
+_max_tasks_per_child: Optional[int] = None
+
+
+class ExecutionMode(NamedTuple):
+    """
+    How the parallel operations of a Stream are executed.
+    """
+
+    kind: str
+    workers: int
+    batch_size: Union[int, str] = "auto"
+    slot: int = 0
+    ordered: bool = True
+    window: int = 2
+    shared_memory: Optional[int] = None
+
+
+def resolve_workers(workers: Union[bool, int]) -> int:
+    """
+    Turn a `parallel` worker argument into a number of workers.
+
+    Args:
+        workers: True to use one worker per CPU, or an explicit number of workers.
+
+    Raises:
+        ValueError: If the number of workers is lower than one.
+
+    Returns:
+        int: The number of workers.
+    """
+    if workers is True:
+        return os.cpu_count() or 1
+    if workers < 1:
+        raise ValueError("workers must be at least one")
+    return int(workers)
+
+
+def configure(
+    warm_up: Iterable[str] = (), max_tasks_per_child: Optional[int] = None
+) -> None:
+    """
+    Configure the process pools. Existing process pools are shut down so that the
+    next parallel Stream starts workers with the new settings.
+
+    Args:
+        warm_up: Names of modules every worker process imports when it starts.
+        max_tasks_per_child: The number of tasks after which a worker process is
+                             replaced by a fresh one, None to keep workers forever.
+
+    Raises:
+        ValueError: If max_tasks_per_child is set on Python older than 3.11.
+    """
+    global _modules, _max_tasks_per_child
+    if max_tasks_per_child is not None and not PROCESS_POOL_RECYCLING:
+        raise ValueError("max_tasks_per_child requires Python 3.11 or newer")
+    with _lock:
+        _modules = tuple(warm_up)
+        _max_tasks_per_child = max_tasks_per_child
+        for key in [key for key in _pools if key[0] == PROCESS]:
+            _pools.pop(key).shutdown(wait=False)
+
+
+def get_pool(kind: str, workers: int, slot: int = 0) -> Executor:
+    """
+    Return the shared pool of a kind, size and slot, creating it on first use.
+
+    Args:
+        kind: Either "thread" or "process".
+        workers: The number of workers of the pool.
+        slot: The position of the parallel stage in its pipeline.
+
+    Raises:
+        ValueError: If the kind is unknown.
+
+    Returns:
+        Executor: The shared pool.
+    """
+    key = (kind, workers, slot)
+    with _lock:
+        pool = _pools.get(key)
+        # A process pool whose worker died abruptly refuses new work: replace it.
+        if pool is None or getattr(pool, "_broken", False):
+            pool = _pools[key] = _create_pool(kind, workers)
+        return pool
+
+
+def get_lanes(count: int, slot: int = 0) -> List[Executor]:
+    """
+    Return 'count' shared lanes, single-thread pools whose tasks run in submission
+    order, creating them on first use.
+
+    Args:
+        count: The number of lanes.
+        slot: The position of the parallel stage in its pipeline.
+
+    Returns:
+        List[Executor]: The shared lanes.
+    """
+    return [get_pool(LANE, index, slot) for index in range(count)]
+
+
+def warm_up(kind: str = PROCESS, workers: Union[bool, int] = True) -> Executor:
+    """
+    Create a shared pool and start all its workers now instead of on first use.
+
+    Args:
+        kind: Either "thread" or "process".
+        workers: True to use one worker per CPU, or an explicit number of workers.
+
+    Returns:
+        Executor: The shared pool.
+    """
+    workers = resolve_workers(workers)
+    pool = get_pool(kind, workers)
+    barrier = None if kind == PROCESS else threading.Barrier(workers)
+    futures = [pool.submit(_ready, _modules, barrier) for _ in range(workers)]
+    for future in futures:
+        future.result()
+    return pool
+
+
+def shutdown(wait: bool = True) -> None:
+    """
+    Shut down every shared pool. Pools are created again on their next use.
+
+    Args:
+        wait: Whether to wait for the running tasks to complete.
+    """
+    with _lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.shutdown(wait=wait)
+
+
+def _create_pool(kind: str, workers: int) -> Executor:
+    if kind == THREAD:
+        return ThreadPoolExecutor(workers, thread_name_prefix="streampy")
+    if kind == LANE:
+        return ThreadPoolExecutor(1, thread_name_prefix="streampy-lane")
+    if kind == PROCESS:
+        # Workers inherit the resource tracker of this process only if it runs
+        # before they start; shared memory transport relies on it, see `transport`.
+        if os.name == "posix":
+            resource_tracker.ensure_running()
+        options = {}
+        if _max_tasks_per_child is not None:
+            options["max_tasks_per_child"] = _max_tasks_per_child
+        return ProcessPoolExecutor(
+            workers, initializer=_import_modules, initargs=(_modules,), **options
+        )
+    raise ValueError(f"Unknown pool kind {kind!r}, expected 'thread' or 'process'")
+
+
+def _import_modules(modules: Tuple[str, ...]) -> None:
+    for module in modules:
+        importlib.import_module(module)
+
+
+def _ready(modules: Tuple[str, ...], barrier: Optional[threading.Barrier]) -> None:
+    # Holding each thread at the barrier forces the pool to start all of them.
+    _import_modules(modules)
+    if barrier is not None:
+        barrier.wait()
+
+
+atexit.register(shutdown)
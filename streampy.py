@@ -1,8 +1,14 @@
+import codecs
 import functools
+import glob
+import heapq
 import itertools
+import operator
 import pathlib
 from collections import defaultdict
 from typing import (
+    AsyncIterable,
+    AsyncIterator,
     Iterable,
     Iterator,
     List,
@@ -16,7 +22,59 @@ from typing import (
     Union,
 )
 
-from functions import _chunk, _compact, _chainer
+import pools
+import transport
+from compatibility import FREE_THREADING
+from functions import (
+    _BatchTuner,
+    _aggregate_batch,
+    _achunk,
+    _adistinct,
+    _afilter,
+    _amap,
+    _asynchronous,
+    _atake,
+    _background,
+    _chainer,
+    _chunk,
+    _compact,
+    _exclude_batch,
+    _filter_batch,
+    _concat_files,
+    _count_lines,
+    _drop_last,
+    _follow,
+    _hash_join,
+    _increment,
+    _interleave_files,
+    _keyed_batch,
+    _map_batch,
+    _merge_join,
+    _parallel,
+    _group_batch,
+    _close_resource,
+    _map_concurrent,
+    _map_with_resource,
+    _memo_map,
+    _MemoCache,
+    _merge_partials,
+    _partitioned_merge,
+    _reduce_batch,
+    _SNIFF_SIZE,
+    _SPLITTABLE_ENCODINGS,
+    _SharedSource,
+    _sample_sort,
+    _shared_view,
+    _timed_chunk,
+    _sharded_distinct,
+    _split_aggregate_batch,
+    _read_batches,
+    _reversed_lines,
+    _sniff_compression,
+    _tree_reduce,
+    _unique,
+    _unique_pairs,
+)
 
 T = TypeVar("T")
 
@@ -27,6 +85,10 @@ class Stream:
     """
 
     __iterator: Iterator[T]
+    __mode: Optional[pools.ExecutionMode] = None
+    __stage: Optional[pools.ExecutionMode] = None
+    __profile: Optional[List[Dict[str, Any]]] = None
+    __source: Optional[pathlib.Path] = None
 
     def __init__(self, *iterable: Iterable[T]) -> None:
         """
@@ -98,6 +160,181 @@ class Stream:
         """
         pass
 
+    def _spawn(self, iterable: Iterable[Any]) -> "Stream":
+        """
+        Create a new Stream over an iterable, keeping the execution mode of this Stream
+        and the parallel stage its items come from.
+
+        Args:
+            iterable: The iterable of the new Stream.
+
+        Returns:
+            Stream: A new Stream.
+        """
+        stream = self.__class__(iterable)
+        stream.__mode = self.__mode
+        stream.__stage = self.__stage
+        stream.__profile = self.__profile
+        return stream
+
+    def parallel(
+        self,
+        thread: Union[bool, int, None] = None,
+        process: Union[bool, int, None] = None,
+        batch_size: Union[int, str] = "auto",
+        ordered: bool = True,
+        window: Optional[int] = None,
+        shared_memory: Union[bool, int] = False,
+    ) -> "Stream":
+        """
+        Run the following map, filter and exclude operations on a shared worker pool.
+
+        Items are sent to the workers in batches. In ordered mode, results come back in
+        the order of the items and at most 'window' batches are in flight or waiting
+        behind a slower one; otherwise results are yielded as soon as their batch
+        completes, so a slow item does not hold back the others. Pools
+        are shared by every Stream of the process and reused across pipelines, see the
+        `pools` module to warm them up or configure them.
+
+        Batches are only submitted as the consumer pulls results: when it stops early,
+        raises, or drops the Stream, batches not started yet are cancelled.
+
+        Each call starts a new stage with its own pool. When items of a parallel stage
+        feed another one, a background thread moves them through a bounded queue, so
+        that the stages run simultaneously and the slowest one sets the throughput.
+
+        Without thread nor process, one worker per CPU is used: threads on a
+        free-threaded interpreter, where they run Python code in parallel without
+        pickling items, and processes otherwise.
+
+        Args:
+            thread: True to use one thread per CPU, or a number of threads.
+            process: True to use one process per CPU, or a number of processes.
+            batch_size: The number of items sent to a worker at once, or "auto" to size
+                        batches from the measured cost of items and tasks. The sizes
+                        chosen are reported by `profile`.
+            ordered: Whether results keep the order of the items.
+            window: The maximum number of batches in flight, twice the number of
+                    workers by default.
+            shared_memory: For processes, True or a size in bytes from which buffers
+                           (bytes, bytearray, memoryview, NumPy arrays) travel to and
+                           from the workers through shared memory instead of the pipe
+                           of the pool, 64 KiB when True. See the `transport` module.
+
+        Raises:
+            ValueError: If both thread and process are given, or if a number of
+                        workers, the batch size or the window is lower than one.
+
+        Returns:
+            Stream: A new Stream running in parallel.
+        """
+        if thread is not None and process is not None:
+            raise ValueError("Only one of thread or process can be given")
+        if thread is None and process is None:
+            if FREE_THREADING:
+                thread = True
+            else:
+                process = True
+        if batch_size != "auto" and (not isinstance(batch_size, int) or batch_size < 1):
+            raise ValueError("batch_size must be at least one or 'auto'")
+        if window is not None and window < 1:
+            raise ValueError("window must be at least one")
+        previous = self.__mode or self.__stage
+        slot = 0 if previous is None else previous.slot + 1
+        kind = pools.THREAD if thread is not None else pools.PROCESS
+        workers = pools.resolve_workers(thread if thread is not None else process)
+        if shared_memory is True:
+            shared_memory = transport.DEFAULT_THRESHOLD
+        mode = pools.ExecutionMode(
+            kind,
+            workers,
+            batch_size,
+            slot,
+            ordered,
+            window or 2 * workers,
+            shared_memory if kind == pools.PROCESS and shared_memory is not False else None,
+        )
+        stream = self._spawn(self.__iterator)
+        stream.__mode = mode
+        if stream.__profile is None:
+            stream.__profile = []
+        return stream
+
+    def sequential(self) -> "Stream":
+        """
+        Run the following operations on the calling thread again.
+
+        Returns:
+            Stream: A new sequential Stream.
+        """
+        stream = self._spawn(self.__iterator)
+        stream.__mode = None
+        return stream
+
+    def __apply(
+        self, operation: str, task: Callable, function: Callable, sequential: Iterable[Any]
+    ) -> "Stream":
+        mode = self.__mode
+        if mode is None:
+            return self._spawn(sequential)
+        fixed = None if mode.batch_size == "auto" else mode.batch_size
+        tuner = _BatchTuner(fixed)
+        self.__profile.append(
+            {
+                "operation": operation,
+                "kind": mode.kind,
+                "workers": mode.workers,
+                "slot": mode.slot,
+                "tuner": tuner,
+            }
+        )
+        iterator = self.__iterator
+        if self.__stage is not None and self.__stage is not mode:
+            iterator = itertools.chain.from_iterable(
+                _background(_chunk(iterator, fixed or 64), mode.window)
+            )
+        pool = pools.get_pool(mode.kind, mode.workers, mode.slot)
+        stream = self._spawn(
+            _parallel(
+                pool,
+                task,
+                self.__ship(function),
+                iterator,
+                tuner,
+                mode.window,
+                mode.ordered,
+                mode.shared_memory,
+            )
+        )
+        stream.__stage = mode
+        return stream
+
+    def __ship(self, function: Any) -> Any:
+        # Lambdas and closures cannot be pickled by reference, they are sent to
+        # process workers by value, serialized once for the whole stage.
+        if self.__mode.kind == pools.PROCESS:
+            return transport.ship(function)
+        return function
+
+    def profile(self) -> List[Dict[str, Any]]:
+        """
+        Describe how the parallel operations of the pipeline ran so far.
+
+        Each entry holds the operation, the kind, number of workers and slot of its
+        pool, the current and successive batch sizes, the measured cost of an item
+        and the fixed cost of a task in seconds, and the number of tasks completed.
+        A batch size found here can be pinned with `parallel(batch_size=...)`.
+
+        Returns:
+            List[Dict[str, Any]]: One entry per parallel operation, in pipeline order.
+        """
+        profile = []
+        for entry in self.__profile or []:
+            entry = dict(entry)
+            entry.update(entry.pop("tuner").profile())
+            profile.append(entry)
+        return profile
+
     def next(self) -> T:
         """
         Return the next item from the iterator.
@@ -110,26 +347,226 @@ class Stream:
         """
         return next(self.__iterator)
 
+    def aiter(self) -> "AsyncStream":
+        """
+        Turn the Stream into an AsyncStream, to chain asynchronous operations.
+
+        Returns:
+            AsyncStream: A new AsyncStream with the items of the Stream.
+        """
+        return AsyncStream(self.__iterator)
+
     def size(self) -> int:
         """
         Return the size of the Stream by consuming the iterator.
 
+        For a Stream created by `Stream.file` on which no operation was applied, line
+        breaks are counted in large binary blocks instead of decoding each line.
+
         Returns:
             int: The number of elements in the Stream.
         """
+        file = self.__file()
+        if file is not None:
+            self.__iterator.close()
+            return _count_lines(file[0])
         return self.__len__()
 
-    def chunk(self, chunk_size: int) -> "Stream":
+    def __file(self) -> Optional[Tuple[pathlib.Path, str]]:
+        # A Stream created by Stream.file, with no line taken from it yet and an
+        # encoding in which lines can be found from any position, can be read from
+        # its end instead of from its start.
+        if self.__source is None:
+            return None
+        try:
+            if self.__iterator.tell() != 0:
+                return None
+            encoding = codecs.lookup(self.__iterator.encoding).name
+        except (AttributeError, LookupError, OSError, TypeError, ValueError):
+            return None
+        if encoding not in _SPLITTABLE_ENCODINGS:
+            return None
+        return self.__source, encoding
+
+    def chunk(self, chunk_size: int, max_wait: Optional[float] = None) -> "Stream":
         """
         Split the Stream into chunks of the specified size.
 
+        With 'max_wait', a chunk is also emitted once 'max_wait' seconds have passed
+        since its first item arrived, even if it is not full, so that items of a slow
+        source such as a followed file are not held back indefinitely. The source is
+        then read on a background thread.
+
         Args:
             chunk_size: The size of each chunk.
+            max_wait: The maximum number of seconds an item waits for its chunk to fill,
+                      or None to always wait for full chunks.
 
         Returns:
             Stream: A new Stream of chunks.
         """
-        return self.__class__(_chunk(self.__iterator, chunk_size))
+        if max_wait is not None:
+            return self._spawn(_timed_chunk(self.__iterator, chunk_size, max_wait))
+        return self._spawn(_chunk(self.__iterator, chunk_size))
+
+    def prefetch(self, buffer_size: int) -> "Stream":
+        """
+        Pull items of the Stream on a background thread, ahead of the consumer.
+
+        Up to 'buffer_size' items are buffered, so a slow source and the following
+        operations run concurrently while the source waits when the buffer is full.
+        Exceptions raised by the source are raised again on the consumer side, and
+        the background thread stops when the Stream is closed or garbage collected.
+
+        Args:
+            buffer_size: The maximum number of items pulled ahead of the consumer.
+
+        Returns:
+            Stream: A new Stream with the same items.
+        """
+        return self._spawn(_background(self.__iterator, buffer_size))
+
+    def memo_map(
+        self, function: Callable[[T], Any], size: int = 1024, path: Optional[str] = None
+    ) -> "Stream":
+        """
+        Apply a pure function to each element of the Stream, computing it once per
+        distinct element.
+
+        Results of the 'size' most recently used elements are kept in memory. With a
+        path, results are also stored in a SQLite database, pickled along with their
+        element, so that they survive restarts and outlive memory evictions. The
+        returned Stream has a `cache_info()` method giving the hits, misses, hits served
+        from disk, maximum and current sizes of the memory cache. Elements must be
+        hashable, and picklable when a path is given.
+
+        Args:
+            function: A pure function to apply to each element.
+            size: The maximum number of results kept in memory.
+            path: The path of a SQLite database, created if needed, or None.
+
+        Raises:
+            ValueError: If size is lower than one.
+            ImportError: If a path is given and the sqlite3 module is not available.
+
+        Returns:
+            Stream: A new Stream with the results, and a `cache_info()` method.
+        """
+        if size < 1:
+            raise ValueError("size must be at least one")
+        cache = _MemoCache(function, size, path)
+        stream = self._spawn(_memo_map(self.__iterator, cache))
+        stream.cache_info = cache.info
+        return stream
+
+    def map_concurrent(
+        self,
+        function: Callable[[T], Any],
+        max_in_flight: int = 16,
+        timeout: Optional[float] = None,
+        on_error: str = "raise",
+    ) -> "Stream":
+        """
+        Apply a blocking function, such as an API call, to many elements of the Stream at once.
+
+        Up to 'max_in_flight' calls run concurrently on threads of a pool owned by the
+        returned Stream, and results keep the order of the elements. A call failing or
+        exceeding 'timeout' seconds raises, is skipped, or is collected in the `errors`
+        list of the returned Stream as an (element, exception) pair, which can be read
+        once the Stream is consumed. The timeout of a call counts from the moment it
+        starts running, and a call exceeding it is left to finish on its own thread
+        while the following elements get threads of their own, as do calls still
+        running when the Stream ends.
+
+        Args:
+            function: The function to apply to each element.
+            max_in_flight: The maximum number of concurrent calls.
+            timeout: The maximum number of seconds a call may take, or None.
+            on_error: "raise" to stop the Stream with the exception, "skip" to drop the
+                      element, or "collect" to drop the element and record the error.
+
+        Raises:
+            ValueError: If max_in_flight is lower than one, timeout is not positive or
+                        on_error is unknown.
+
+        Returns:
+            Stream: A new Stream with the results, and an `errors` list.
+        """
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least one")
+        if timeout is not None and timeout <= 0:
+            raise ValueError("timeout must be positive")
+        if on_error not in ("raise", "skip", "collect"):
+            raise ValueError("on_error must be 'raise', 'skip' or 'collect'")
+        errors = []
+        stream = self._spawn(
+            _map_concurrent(self.__iterator, function, max_in_flight, timeout, on_error, errors)
+        )
+        stream.errors = errors
+        return stream
+
+    def map_with_resource(
+        self,
+        function: Callable[[Any, T], Any],
+        factory: Callable[[], Any],
+        pool_size: Optional[int] = None,
+        close: Optional[Callable[[Any], None]] = None,
+    ) -> "Stream":
+        """
+        Apply a function to each element of the Stream along with a reusable resource,
+        such as a database connection or an HTTP client.
+
+        Each thread calling the function creates its resource with 'factory' on its
+        first element and reuses it for the following ones. Without a pool size,
+        elements are mapped on the consuming thread with a single resource; with one,
+        'pool_size' threads map elements concurrently, keeping their order. Resources
+        are closed once the Stream is exhausted, closed or garbage collected.
+
+        Args:
+            function: A function called with a resource and an element.
+            factory: A function creating a resource.
+            pool_size: The number of threads, each holding its own resource, or None.
+            close: A function closing a resource, its close method by default.
+
+        Raises:
+            ValueError: If pool_size is lower than one.
+
+        Returns:
+            Stream: A new Stream with the results.
+        """
+        if pool_size is not None and pool_size < 1:
+            raise ValueError("pool_size must be at least one")
+        return self._spawn(
+            _map_with_resource(
+                self.__iterator, function, factory, close or _close_resource, pool_size
+            )
+        )
+
+    def shared(self, consumers: int, batch_size: int = 64) -> Tuple["Stream", ...]:
+        """
+        Split the Stream into views for concurrent consumers pulling from one source.
+
+        Each item goes to exactly one view. Views take items from the source in batches
+        of 'batch_size' under a single lock acquisition, so that many threads can
+        consume one iterator, such as a file, without contending for each item. A view
+        should be consumed by a single thread.
+
+        Args:
+            consumers: The number of views.
+            batch_size: The number of items a view takes from the source at once.
+
+        Raises:
+            ValueError: If consumers or batch_size is lower than one.
+
+        Returns:
+            Tuple[Stream, ...]: A Stream per consumer.
+        """
+        if consumers < 1:
+            raise ValueError("consumers must be at least one")
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least one")
+        source = _SharedSource(self.__iterator, batch_size)
+        return tuple(self._spawn(_shared_view(source)) for _ in range(consumers))
 
     def compact(self) -> "Stream":
         """
@@ -138,7 +575,7 @@ class Stream:
         Returns:
             Stream: A new Stream without falsy values.
         """
-        return self.__class__(_compact(self.__iterator))
+        return self._spawn(_compact(self.__iterator))
 
     def chain(self, *iterables: Iterable[T]) -> "Stream":
         """
@@ -150,7 +587,7 @@ class Stream:
         Returns:
             Stream: A new Stream with the chained iterables.
         """
-        return self.__class__(_chainer(self.__iterator, *iterables))
+        return self._spawn(_chainer(self.__iterator, *iterables))
 
     def concat(self) -> "Stream":
         """
@@ -159,7 +596,7 @@ class Stream:
         Returns:
             Stream: A new Stream with the concatenated sub-iterables.
         """
-        return self.__class__(_chainer(*self.__iterator))
+        return self._spawn(_chainer(*self.__iterator))
 
     def to_list(self) -> List[T]:
         """
@@ -195,9 +632,16 @@ class Stream:
         """
         Return the last item of the Stream, or None if the Stream is empty.
 
+        A Stream created by `Stream.file` on which no operation was applied is read
+        backwards from the end of the file.
+
         Returns:
             Optional[T]: The last item or None.
         """
+        file = self.__file()
+        if file is not None:
+            self.__iterator.close()
+            return next(_reversed_lines(*file), None)
         item = None
         for item in self.__iterator:
             pass
@@ -213,7 +657,9 @@ class Stream:
         Returns:
             Stream: A new Stream with filtered items.
         """
-        return self.__class__(filter(predicate, self.__iterator))
+        return self.__apply(
+            "filter", _filter_batch, predicate, filter(predicate, self.__iterator)
+        )
 
     def peek(self, action: Callable[[T], Any]) -> "Stream":
         """
@@ -231,7 +677,7 @@ class Stream:
                 action(item)
                 yield item
 
-        return self.__class__(gen())
+        return self._spawn(gen())
 
     def min(self, key: Optional[Callable[[T], Any]] = None) -> Optional[T]:
         """
@@ -273,7 +719,12 @@ class Stream:
         Returns:
             Stream: A new Stream with excluded items.
         """
-        return self.__class__((item for item in self.__iterator if not predicate(item)))
+        return self.__apply(
+            "exclude",
+            _exclude_batch,
+            predicate,
+            (item for item in self.__iterator if not predicate(item)),
+        )
 
     def map(self, function: Callable[[T], Any]) -> "Stream":
         """
@@ -285,7 +736,7 @@ class Stream:
         Returns:
             Stream: A new Stream with the mapped items.
         """
-        return self.__class__(map(function, self.__iterator))
+        return self.__apply("map", _map_batch, function, map(function, self.__iterator))
 
     def sort(
         self, key: Optional[Callable[[T], Any]] = None, reverse: bool = False
@@ -293,6 +744,10 @@ class Stream:
         """
         Sort items in the Stream based on a key function.
 
+        When the Stream runs in parallel, a sample of the keys picks splitters that
+        range-partition the items, each range is sorted by a worker and the ranges are
+        concatenated. The sort stays stable.
+
         Args:
             key: A function to extract a comparison key from each item.
             reverse: Whether to sort in descending order.
@@ -300,7 +755,16 @@ class Stream:
         Returns:
             Stream: A new Stream with sorted items.
         """
-        return self.__class__(sorted(self.__iterator, key=key, reverse=reverse))
+        return self._spawn(self.__sort(key, reverse))
+
+    def __sort(self, key: Optional[Callable[[T], Any]], reverse: bool) -> List[T]:
+        mode = self.__mode
+        if mode is None:
+            return sorted(self.__iterator, key=key, reverse=reverse)
+        pool = pools.get_pool(mode.kind, mode.workers, mode.slot)
+        return _sample_sort(
+            pool, list(self.__iterator), key, reverse, mode.workers, mode.window, self.__ship
+        )
 
     def limit(self, count: int) -> "Stream":
         """
@@ -312,7 +776,7 @@ class Stream:
         Returns:
             Stream: A new Stream with limited items.
         """
-        return self.__class__(itertools.islice(self.__iterator, count))
+        return self._spawn(itertools.islice(self.__iterator, count))
 
     def any(self, predicate: Callable[[T], bool]) -> bool:
         """
@@ -379,7 +843,7 @@ class Stream:
         Returns:
             Stream: A new Stream with the taken elements.
         """
-        return self.__class__(itertools.islice(self.__iterator, count))
+        return self._spawn(itertools.islice(self.__iterator, count))
 
     def take_while(self, predicate: Callable[[T], bool]) -> "Stream":
         """
@@ -391,12 +855,15 @@ class Stream:
         Returns:
             Stream: A new Stream with the taken elements while the predicate is true.
         """
-        return self.__class__(itertools.takewhile(predicate, self.__iterator))
+        return self._spawn(itertools.takewhile(predicate, self.__iterator))
 
     def take_right(self, count: int) -> "Stream":
         """
         Take the last 'count' elements from the Stream.
 
+        A Stream created by `Stream.file` on which no operation was applied is read
+        backwards from the end of the file.
+
         Args:
             count: The number of elements to take from the end.
 
@@ -405,6 +872,11 @@ class Stream:
         """
 
         def gen():
+            file = self.__file()
+            if file is not None:
+                self.__iterator.close()
+                yield from reversed(list(itertools.islice(_reversed_lines(*file), max(count, 0))))
+                return
             cache = []
             for item in self.__iterator:
                 cache.append(item)
@@ -413,12 +885,15 @@ class Stream:
             for item in cache:
                 yield item
 
-        return self.__class__(gen())
+        return self._spawn(gen())
 
     def take_right_while(self, predicate: Callable[[T], bool]) -> "Stream":
         """
         Take elements from the end of the Stream while the predicate is true.
 
+        A Stream created by `Stream.file` on which no operation was applied is read
+        backwards from the end of the file.
+
         Args:
             predicate: A function to test each element.
 
@@ -427,6 +902,11 @@ class Stream:
         """
 
         def gen():
+            file = self.__file()
+            if file is not None:
+                self.__iterator.close()
+                yield from itertools.takewhile(predicate, _reversed_lines(*file))
+                return
             cache = []
             for item in self.__iterator:
                 cache.append(item)
@@ -436,7 +916,7 @@ class Stream:
                 else:
                     break
 
-        return self.__class__(reversed(list(gen())))
+        return self._spawn(reversed(list(gen())))
 
     def flatten(self) -> "Stream":
         """
@@ -445,7 +925,7 @@ class Stream:
         Returns:
             Stream: A new Stream with flattened items.
         """
-        return self.__class__(item for sublist in self.__iterator for item in sublist)
+        return self._spawn(item for sublist in self.__iterator for item in sublist)
 
     def flatten_deep(self) -> "Stream":
         """
@@ -462,7 +942,7 @@ class Stream:
                 else:
                     yield item
 
-        return self.__class__(gen(self.__iterator))
+        return self._spawn(gen(self.__iterator))
 
     def join(self, separator: str) -> str:
         """
@@ -476,6 +956,95 @@ class Stream:
         """
         return separator.join(map(str, self.__iterator))
 
+    def inner_join(
+        self,
+        other: Iterable[Any],
+        key: Callable[[T], Any],
+        other_key: Optional[Callable[[Any], Any]] = None,
+        method: str = "hash",
+        max_build_size: int = 1_000_000,
+    ) -> "Stream":
+        """
+        Join the Stream with another iterable on equal keys, keeping only matching pairs.
+
+        The "hash" method builds a hash table of the other iterable and streams the
+        Stream against it, preserving the order of the Stream. When the other iterable
+        holds more than 'max_build_size' items, both sides are partitioned to temporary
+        files by key hash and joined partition by partition, building each one on its
+        smaller side; the output order is then unspecified. A partition whose smaller
+        side still holds more than 'max_build_size' items is partitioned again, so that
+        memory stays bounded unless a single key holds too many items. Spilled items
+        and their keys must be picklable. The "merge" method expects both sides to be
+        sorted by key and joins them in a single streaming pass.
+
+        Args:
+            other: The iterable to join with.
+            key: A function to extract the join key from each item of the Stream.
+            other_key: A function to extract the join key from each item of the other
+                       iterable. Defaults to 'key'.
+            method: The join algorithm, "hash" or "merge".
+            max_build_size: The number of items held in memory before a hash join spills
+                            to disk.
+
+        Raises:
+            ValueError: If the method is unknown.
+
+        Returns:
+            Stream: A new Stream of (item, other_item) tuples.
+        """
+        return self.__join(other, key, other_key, method, max_build_size, False)
+
+    def left_join(
+        self,
+        other: Iterable[Any],
+        key: Callable[[T], Any],
+        other_key: Optional[Callable[[Any], Any]] = None,
+        method: str = "hash",
+        max_build_size: int = 1_000_000,
+    ) -> "Stream":
+        """
+        Join the Stream with another iterable on equal keys, keeping every item of the Stream.
+
+        Items of the Stream without a match are paired with None. See `inner_join` for
+        the join methods, and for items and keys of a hash join spilling to disk, which
+        must be picklable.
+
+        Args:
+            other: The iterable to join with.
+            key: A function to extract the join key from each item of the Stream.
+            other_key: A function to extract the join key from each item of the other
+                       iterable. Defaults to 'key'.
+            method: The join algorithm, "hash" or "merge".
+            max_build_size: The number of items held in memory before a hash join spills
+                            to disk.
+
+        Raises:
+            ValueError: If the method is unknown.
+
+        Returns:
+            Stream: A new Stream of (item, other_item or None) tuples.
+        """
+        return self.__join(other, key, other_key, method, max_build_size, True)
+
+    def __join(
+        self,
+        other: Iterable[Any],
+        key: Callable[[T], Any],
+        other_key: Optional[Callable[[Any], Any]],
+        method: str,
+        max_build_size: int,
+        outer: bool,
+    ) -> "Stream":
+        if other_key is None:
+            other_key = key
+        if method == "hash":
+            return self._spawn(
+                _hash_join(self.__iterator, other, key, other_key, outer, max_build_size)
+            )
+        if method == "merge":
+            return self._spawn(_merge_join(self.__iterator, other, key, other_key, outer))
+        raise ValueError(f"Unknown join method {method!r}, expected 'hash' or 'merge'")
+
     def remove(self, predicate: Callable[[T], bool]) -> "Stream":
         """
         Remove items from the Stream that match the predicate function.
@@ -486,19 +1055,31 @@ class Stream:
         Returns:
             Stream: A new Stream with items removed.
         """
-        return self.__class__(item for item in self.__iterator if not predicate(item))
+        return self._spawn(item for item in self.__iterator if not predicate(item))
 
-    def distinct(self, predicate: Optional[Callable[[T], Any]] = None) -> "Stream":
+    def distinct(
+        self, predicate: Optional[Callable[[T], Any]] = None, ordered: bool = True
+    ) -> "Stream":
         """
         Remove duplicate elements from the Stream, preserving order.
         If a predicate is provided, it is used to determine uniqueness.
 
+        When the Stream runs in parallel, keys are computed by the workers. On a
+        free-threaded interpreter, they are then routed by hash to shards, each owning
+        a disjoint set of keys on its own thread; otherwise the set of seen keys stays
+        with the consumer.
+
         Args:
             predicate: A function to determine the uniqueness of elements.
+            ordered: Whether a parallel Stream keeps the order of first occurrences,
+                     rather than the order in which shards complete within a batch.
 
         Returns:
             Stream: A new Stream with unique elements.
         """
+        if self.__mode is not None:
+            return self.__sharded_distinct(predicate, ordered)
+
         seen = set()
 
         def gen():
@@ -508,18 +1089,28 @@ class Stream:
                     seen.add(key)
                     yield item
 
-        return self.__class__(gen())
+        return self._spawn(gen())
 
-    def distinct_by(self, key_function: Callable[[T], Any]) -> "Stream":
+    def distinct_by(self, key_function: Callable[[T], Any], ordered: bool = True) -> "Stream":
         """
         Remove duplicate elements from the Stream based on a key function, preserving order.
 
+        When the Stream runs in parallel, keys are computed by the workers. On a
+        free-threaded interpreter, they are then routed by hash to shards, each owning
+        a disjoint set of keys on its own thread; otherwise the set of seen keys stays
+        with the consumer.
+
         Args:
             key_function: A function to extract the key for determining uniqueness.
+            ordered: Whether a parallel Stream keeps the order of first occurrences,
+                     rather than the order in which shards complete within a batch.
 
         Returns:
             Stream: A new Stream with unique elements based on the key function.
         """
+        if self.__mode is not None:
+            return self.__sharded_distinct(key_function, ordered)
+
         seen = set()
 
         def gen():
@@ -529,7 +1120,25 @@ class Stream:
                     seen.add(key)
                     yield item
 
-        return self.__class__(gen())
+        return self._spawn(gen())
+
+    def __sharded_distinct(
+        self, key_function: Optional[Callable[[T], Any]], ordered: bool
+    ) -> "Stream":
+        # With the GIL, shards cannot check keys at the same time and would only add
+        # hand-offs between threads, so the consumer keeps the set of seen keys.
+        mode = self.__mode
+        if key_function is None:
+            if not FREE_THREADING:
+                return self._spawn(_unique(self.__iterator))
+            pairs = ((item, item) for item in self.__iterator)
+        else:
+            pairs = self.__apply("distinct", _keyed_batch, key_function, self.__iterator)
+            if not FREE_THREADING:
+                return self._spawn(_unique_pairs(pairs))
+        batch_size = 1024 if mode.batch_size == "auto" else mode.batch_size
+        lanes = pools.get_lanes(mode.workers, mode.slot)
+        return self._spawn(_sharded_distinct(pairs, lanes, batch_size, mode.window, ordered))
 
     def drop(self, count: int) -> "Stream":
         """
@@ -541,7 +1150,7 @@ class Stream:
         Returns:
             Stream: A new Stream with the elements dropped.
         """
-        return self.__class__(itertools.islice(self.__iterator, count, None))
+        return self._spawn(itertools.islice(self.__iterator, count, None))
 
     def drop_while(self, predicate: Callable[[T], bool]) -> "Stream":
         """
@@ -563,7 +1172,7 @@ class Stream:
             for item in iterator:
                 yield item
 
-        return self.__class__(gen())
+        return self._spawn(gen())
 
     def drop_right(self, count: int) -> "Stream":
         """
@@ -584,12 +1193,16 @@ class Stream:
                 if len(cache) > count:
                     yield cache.pop(0)
 
-        return self.__class__(gen())
+        return self._spawn(gen())
 
     def drop_right_while(self, predicate: Callable[[T], bool]) -> "Stream":
         """
         Drop elements from the end of the Stream while the predicate is true.
 
+        A Stream created by `Stream.file` on which no operation was applied is read
+        backwards from the end of the file to find the elements to drop, then read
+        from its start without buffering the kept elements.
+
         Args:
             predicate: A function to test each element.
 
@@ -598,6 +1211,11 @@ class Stream:
         """
 
         def gen():
+            file = self.__file()
+            if file is not None:
+                dropped = sum(1 for _ in itertools.takewhile(predicate, _reversed_lines(*file)))
+                yield from _drop_last(self.__iterator, dropped)
+                return
             cache = []
             for item in self.__iterator:
                 cache.append(item)
@@ -606,7 +1224,7 @@ class Stream:
             for item in cache:
                 yield item
 
-        return self.__class__(gen())
+        return self._spawn(gen())
 
     def fill(self, value: T, start: int = 0, end: Optional[int] = None) -> "Stream":
         """
@@ -629,19 +1247,35 @@ class Stream:
                 else:
                     yield item
 
-        return self.__class__(gen())
+        return self._spawn(gen())
 
-    def reduce(self, function: Callable[[T, T], T], initial: Optional[T] = None) -> T:
+    def reduce(
+        self,
+        function: Callable[[T, T], T],
+        initial: Optional[T] = None,
+        combiner: Optional[Callable[[T, T], T]] = None,
+    ) -> T:
         """
         Reduce the Stream to a single value using a binary function and an optional initial value.
 
+        When the Stream runs in parallel and a combiner is given, each batch is reduced
+        by a worker, starting from a copy of the initial value, and the partial results
+        are combined pairwise in a tree. The combiner must be associative and the initial
+        value neutral for it; without ordered results it must also be commutative.
+
         Args:
             function: A binary function to apply to the elements.
             initial: An optional initial value to start the reduction.
+            combiner: An optional binary function combining two partial results.
 
         Returns:
             T: The reduced value.
         """
+        if combiner is not None and self.__mode is not None:
+            partials = self.__apply(
+                "reduce", _reduce_batch, (function, initial), self.__iterator
+            )
+            return _tree_reduce(combiner, partials, initial)
         if initial is None:
             return functools.reduce(function, self.__iterator)
         else:
@@ -651,6 +1285,11 @@ class Stream:
         """
         Group elements of the Stream by a specified key function.
 
+        When the Stream runs in parallel, each worker groups its batch into a partial
+        dictionary of its own, and partials are merged by the caller, so that workers
+        never share the dictionary. Groups keep the order of the elements unless the
+        Stream was made parallel with ordered=False.
+
         Args:
             key_function: A function to extract the key for grouping.
 
@@ -658,12 +1297,64 @@ class Stream:
             Dict[Any, List[T]]: A dictionary where keys are the results of applying the key function,
                                 and values are lists of elements corresponding to those keys.
         """
+        if self.__mode is not None:
+            partials = self.__apply("group_by", _group_batch, key_function, self.__iterator)
+            return _merge_partials(operator.iadd, partials)
         grouped = defaultdict(list)
         for item in self.__iterator:
             key = key_function(item)
             grouped[key].append(item)
         return dict(grouped)
 
+    def aggregate_by(
+        self,
+        key_function: Callable[[T], Any],
+        function: Callable[[Any, T], Any],
+        initial: Any,
+        combiner: Optional[Callable[[Any, Any], Any]] = None,
+    ) -> Dict[Any, Any]:
+        """
+        Aggregate elements of the Stream per key, without keeping the elements themselves.
+
+        When the Stream runs in parallel and a combiner is given, each worker aggregates
+        its batch into a partial dictionary split by key hash, so that only partial
+        aggregates come back from the workers. Each split is then merged by its own
+        task.
+
+        Args:
+            key_function: A function to extract the key of each element.
+            function: A binary function folding an element into the aggregate of its key.
+            initial: The aggregate of a key before its first element, copied per key.
+            combiner: An optional binary function combining two partial aggregates of
+                      the same key.
+
+        Returns:
+            Dict[Any, Any]: A dictionary of the aggregate of each key.
+        """
+        if combiner is None or self.__mode is None:
+            return _aggregate_batch((key_function, function, initial), self.__iterator)[0]
+        partitions = self.__mode.workers
+        partials = self.__apply(
+            "aggregate_by",
+            _split_aggregate_batch,
+            (key_function, function, initial, partitions),
+            self.__iterator,
+        )
+        pool = pools.get_pool(self.__mode.kind, self.__mode.workers, self.__mode.slot)
+        return _partitioned_merge(pool, self.__ship(combiner), partials, partitions)
+
+    def count_by(self, key_function: Callable[[T], Any]) -> Dict[Any, int]:
+        """
+        Count elements of the Stream per key, in parallel when the Stream runs in parallel.
+
+        Args:
+            key_function: A function to extract the key of each element.
+
+        Returns:
+            Dict[Any, int]: A dictionary of the number of elements of each key.
+        """
+        return self.aggregate_by(key_function, _increment, 0, operator.add)
+
     def partition_by(self, predicate: Callable[[T], bool]) -> Tuple["Stream", "Stream"]:
         """
         Partition elements of the Stream into two Streams based on a predicate.
@@ -678,7 +1369,7 @@ class Stream:
         true_part, false_part = [], []
         for item in self.__iterator:
             (true_part if predicate(item) else false_part).append(item)
-        return self.__class__(iter(true_part)), self.__class__(iter(false_part))
+        return self._spawn(iter(true_part)), self._spawn(iter(false_part))
 
     def skip(self, count: int) -> "Stream":
         """
@@ -690,7 +1381,7 @@ class Stream:
         Returns:
             Stream: A new Stream with the elements skipped.
         """
-        return self.__class__(itertools.islice(self.__iterator, count, None))
+        return self._spawn(itertools.islice(self.__iterator, count, None))
 
     def skip_while(self, predicate: Callable[[T], bool]) -> "Stream":
         """
@@ -712,7 +1403,7 @@ class Stream:
             for item in iterator:
                 yield item
 
-        return self.__class__(gen())
+        return self._spawn(gen())
 
     def sorted(
         self, key: Optional[Callable[[T], Any]] = None, reverse: bool = False
@@ -720,6 +1411,10 @@ class Stream:
         """
         Sort elements of the Stream based on a key function and order.
 
+        When the Stream runs in parallel, a sample of the keys picks splitters that
+        range-partition the elements, each range is sorted by a worker and the ranges
+        are concatenated. The sort stays stable.
+
         Args:
             key: A function to extract a comparison key from each element.
             reverse: Whether to sort in descending order.
@@ -727,7 +1422,7 @@ class Stream:
         Returns:
             Stream: A new Stream with sorted elements.
         """
-        return self.__class__(sorted(self.__iterator, key=key, reverse=reverse))
+        return self._spawn(self.__sort(key, reverse))
 
     def flat_map(self, function: Callable[[T], Iterable[Any]]) -> "Stream":
         """
@@ -745,7 +1440,7 @@ class Stream:
                 for result in function(item):
                     yield result
 
-        return self.__class__(gen())
+        return self._spawn(gen())
 
     def count(self) -> int:
         """
@@ -794,12 +1489,62 @@ class Stream:
         return cls(range(*args))
 
     @classmethod
-    def file(cls, path: Union[str, pathlib.Path]) -> "Stream":
+    def merge_sorted(
+        cls,
+        *iterables: Iterable[T],
+        key: Optional[Callable[[T], Any]] = None,
+        reverse: bool = False,
+    ) -> "Stream":
+        """
+        Lazily merge iterables that are each already sorted into a single sorted Stream.
+
+        The merge keeps one item per input in a heap, so it runs in O(n log k) time and
+        O(k) memory for k inputs.
+
+        Args:
+            iterables: Iterables sorted by the same key and order.
+            key: A function to extract a comparison key from each item.
+            reverse: Whether the inputs are sorted in descending order.
+
+        Returns:
+            Stream: A new Stream with the merged items.
+        """
+        return cls(heapq.merge(*iterables, key=key, reverse=reverse))
+
+    @classmethod
+    def file(
+        cls,
+        path: Union[str, pathlib.Path],
+        buffer_size: int = 16,
+        follow: bool = False,
+        poll_interval: float = 0.5,
+    ) -> "Stream":
         """
         Create a Stream from a file, reading it line by line.
 
+        Files compressed with gzip, bzip2 or xz are detected by their magic bytes and
+        decompressed on a background thread, so decompression overlaps with the
+        processing of the pipeline.
+
+        With 'follow', the Stream does not end at the end of the file but waits for
+        lines appended to it, like `tail -F`. The file is checked every few
+        milliseconds after a write, and less often while nothing is written, up to
+        'poll_interval' seconds. A rotated file is read to its end before the new
+        file at the same path is read, and a truncated file is read again from its
+        start. A last line without a line break is only yielded once completed.
+
         Args:
             path: The path to the file.
+            buffer_size: The number of decompressed blocks of lines buffered ahead of
+                         the consumer for compressed files.
+            follow: Whether to keep reading lines appended to the file.
+            poll_interval: The maximum number of seconds between two checks of a
+                           followed file.
+
+        Raises:
+            FileNotFoundError: If the path does not exist or is not a file.
+            ImportError: If the file is compressed with a format whose module is missing.
+            ValueError: If a compressed file is followed, or poll_interval is not positive.
 
         Returns:
             Stream: A new Stream with lines from the file.
@@ -808,4 +1553,193 @@ class Stream:
             path = pathlib.Path(path)
         if not path.is_file():
             raise FileNotFoundError(f"The path {path} does not exist or is not a file.")
-        return cls(path.open())
+        with path.open("rb") as handle:
+            module = _sniff_compression(handle.read(_SNIFF_SIZE))
+        if follow:
+            if module is not None:
+                raise ValueError("Compressed files cannot be followed")
+            if poll_interval <= 0:
+                raise ValueError("poll_interval must be positive")
+            return cls(_follow(path, poll_interval))
+        if module is None:
+            stream = cls(path.open())
+            stream.__source = path
+            return stream
+        return cls(
+            itertools.chain.from_iterable(
+                _background(_read_batches(module.open, path), buffer_size)
+            )
+        )
+
+    @classmethod
+    def files(
+        cls,
+        pattern: Union[str, pathlib.Path],
+        ordered: bool = False,
+        max_open: int = 8,
+        with_path: bool = False,
+        buffer_size: int = 64,
+    ) -> "Stream":
+        """
+        Create a Stream from every file matching a glob pattern, reading them concurrently.
+
+        Each file is read, and decompressed like in `Stream.file`, on its own background
+        thread. At most 'max_open' files are open at once, and each file is closed as soon
+        as it is exhausted.
+
+        Args:
+            pattern: A glob pattern, '**' matches any number of sub-directories.
+            ordered: Whether to yield the files one after the other in path order instead
+                     of interleaving their lines as they are read.
+            max_open: The maximum number of files read at the same time.
+            with_path: Whether to yield (path, line) tuples instead of lines.
+            buffer_size: The number of blocks of lines buffered ahead of the consumer.
+
+        Raises:
+            ValueError: If max_open or buffer_size is lower than one.
+
+        Returns:
+            Stream: A new Stream with lines from all the matching files.
+        """
+        if max_open < 1:
+            raise ValueError("max_open must be at least one")
+        if buffer_size < 1:
+            raise ValueError("buffer_size must be at least one")
+        paths = (
+            pathlib.Path(path)
+            for path in sorted(glob.glob(str(pattern), recursive=True))
+            if pathlib.Path(path).is_file()
+        )
+        reader = _concat_files if ordered else _interleave_files
+        return cls(reader(paths, max_open, with_path, buffer_size))
+
+
+class AsyncStream:
+    """
+    AsyncStream class for functional-style operations on asynchronous sequences.
+    """
+
+    __iterator: AsyncIterator[T]
+
+    def __init__(self, *iterable: Union[AsyncIterable[T], Iterable[T]]) -> None:
+        """
+        Initialize the AsyncStream with an asynchronous or a synchronous iterable.
+
+        Args:
+            iterable: An iterable to be processed by the AsyncStream. Only one iterable is allowed.
+
+        Raises:
+            TypeError: If more than one iterable is provided or if the provided iterable is None.
+        """
+        if len(iterable) == 1:
+            if iterable[0] is None:
+                raise TypeError("Argument is None")
+            if isinstance(iterable[0], AsyncIterable):
+                self.__iterator = iterable[0].__aiter__()
+            else:
+                self.__iterator = _asynchronous(iterable[0])
+        elif len(iterable) > 1:
+            raise TypeError("Takes only one argument")
+        else:
+            self.__iterator = _asynchronous([])
+
+    def __aiter__(self) -> AsyncIterator[T]:
+        """
+        Return the asynchronous iterator for the AsyncStream.
+
+        Returns:
+            AsyncIterator[T]: The asynchronous iterator of the AsyncStream.
+        """
+        return self.__iterator
+
+    def map(
+        self,
+        function: Callable[[T], Any],
+        max_concurrency: int = 1,
+        ordered: bool = True,
+    ) -> "AsyncStream":
+        """
+        Apply a function or a coroutine function to each item in the AsyncStream.
+
+        Up to 'max_concurrency' calls are awaited concurrently.
+
+        Args:
+            function: A function, or a coroutine function, to apply to each item.
+            max_concurrency: The maximum number of calls in flight.
+            ordered: Whether to keep the order of the items, or to yield results as
+                     soon as they are ready.
+
+        Returns:
+            AsyncStream: A new AsyncStream with the mapped items.
+        """
+        return self.__class__(_amap(self.__iterator, function, max_concurrency, ordered))
+
+    def filter(self, predicate: Callable[[T], Any]) -> "AsyncStream":
+        """
+        Filter items in the AsyncStream based on a predicate function or coroutine function.
+
+        Args:
+            predicate: A function, or a coroutine function, to filter items.
+
+        Returns:
+            AsyncStream: A new AsyncStream with filtered items.
+        """
+        return self.__class__(_afilter(self.__iterator, predicate))
+
+    def chunk(self, chunk_size: int) -> "AsyncStream":
+        """
+        Split the AsyncStream into chunks of the specified size.
+
+        Args:
+            chunk_size: The size of each chunk.
+
+        Returns:
+            AsyncStream: A new AsyncStream of chunks.
+        """
+        return self.__class__(_achunk(self.__iterator, chunk_size))
+
+    def distinct(self, predicate: Optional[Callable[[T], Any]] = None) -> "AsyncStream":
+        """
+        Remove duplicate elements from the AsyncStream, preserving order.
+        If a predicate is provided, it is used to determine uniqueness.
+
+        Args:
+            predicate: A function to determine the uniqueness of elements.
+
+        Returns:
+            AsyncStream: A new AsyncStream with unique elements.
+        """
+        return self.__class__(_adistinct(self.__iterator, predicate))
+
+    def take(self, count: int) -> "AsyncStream":
+        """
+        Take the first 'count' elements from the AsyncStream.
+
+        Args:
+            count: The number of elements to take.
+
+        Returns:
+            AsyncStream: A new AsyncStream with the taken elements.
+        """
+        return self.__class__(_atake(self.__iterator, count))
+
+    async def to_list(self) -> List[T]:
+        """
+        Convert the AsyncStream to a list.
+
+        Returns:
+            List[T]: A list of elements in the AsyncStream.
+        """
+        return [item async for item in self.__iterator]
+
+    async def first(self) -> Optional[T]:
+        """
+        Return the first item of the AsyncStream, or None if the AsyncStream is empty.
+
+        Returns:
+            Optional[T]: The first item or None.
+        """
+        try:
+            return await self.__iterator.__anext__()
+        except StopAsyncIteration:
+            return None
@@ -1,8 +1,24 @@
 import unittest
 from unittest.mock import mock_open, patch
+from collections import Counter
+import asyncio
+import bz2
+import gzip
+import lzma
+import operator
+import os
 import pathlib
+import random
+import sys
+import tempfile
+import threading
+import time
 
-from streampy import Stream
+import functions
+import pools
+import transport
+from compatibility import FREE_THREADING, PROCESS_POOL_RECYCLING
+from streampy import AsyncStream, Stream
 
 
 class CreationTest(unittest.TestCase):
@@ -1526,3 +1542,1588 @@ class FileTest(unittest.TestCase):
     def test_file_with_chunk(self, mock_is_file, mock_file):
         s = Stream.file("dummy_path").chunk(2)
         self.assertEqual(s.to_list(), [["line1\n", "line2\n"], ["line3\n", "line4"]])
+
+
+class CompressedFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.lines = [f"line{i}\n" for i in range(1000)]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, opener):
+        path = pathlib.Path(self.directory.name) / name
+        with opener(path, "wt") as file:
+            file.writelines(self.lines)
+        return path
+
+    def test_file_gzip(self):
+        path = self.write("data.log.gz", gzip.open)
+        self.assertEqual(Stream.file(path).to_list(), self.lines)
+
+    def test_file_bz2(self):
+        path = self.write("data.log.bz2", bz2.open)
+        self.assertEqual(Stream.file(path).to_list(), self.lines)
+
+    def test_file_xz(self):
+        path = self.write("data.log.xz", lzma.open)
+        self.assertEqual(Stream.file(path).to_list(), self.lines)
+
+    def test_text_starting_like_bzip2(self):
+        path = pathlib.Path(self.directory.name) / "words.txt"
+        path.write_text("BZh is a word\nBZh91AY\n")
+        self.assertEqual(Stream.file(path).to_list(), ["BZh is a word\n", "BZh91AY\n"])
+        self.assertEqual(Stream.files(path).to_list(), ["BZh is a word\n", "BZh91AY\n"])
+
+    def test_empty_bz2(self):
+        path = pathlib.Path(self.directory.name) / "empty.bz2"
+        path.write_bytes(bz2.compress(b""))
+        self.assertEqual(Stream.file(path).to_list(), [])
+
+    def test_file_detected_by_magic_bytes(self):
+        path = self.write("data.log", gzip.open)
+        self.assertEqual(Stream.file(path).size(), 1000)
+
+    def test_file_plain_text(self):
+        path = self.write("data.log", open)
+        self.assertEqual(Stream.file(path).to_list(), self.lines)
+
+    def test_file_compressed_with_limit(self):
+        path = self.write("data.log.gz", gzip.open)
+        self.assertEqual(Stream.file(path).limit(2).to_list(), self.lines[:2])
+
+    def test_file_corrupted_propagates_error(self):
+        path = pathlib.Path(self.directory.name) / "broken.gz"
+        path.write_bytes(gzip.compress(b"".join(l.encode() for l in self.lines))[:200])
+        with self.assertRaises(EOFError):
+            Stream.file(path).to_list()
+
+
+class FilesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self.directory.name)
+        for i in range(5):
+            (self.root / f"{i}.log").write_text("".join(f"{i}-{j}\n" for j in range(100)))
+        with gzip.open(self.root / "5.log", "wt") as file:
+            file.writelines(f"5-{j}\n" for j in range(100))
+        self.expected = [f"{i}-{j}\n" for i in range(6) for j in range(100)]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_files_unordered(self):
+        s = Stream.files(self.root / "*.log", max_open=2)
+        self.assertEqual(sorted(s.to_list()), sorted(self.expected))
+
+    def test_files_unordered_keeps_lines_order_per_file(self):
+        lines = Stream.files(self.root / "*.log").filter(lambda x: x.startswith("3-"))
+        self.assertEqual(lines.to_list(), [f"3-{j}\n" for j in range(100)])
+
+    def test_files_ordered(self):
+        s = Stream.files(self.root / "*.log", ordered=True, max_open=3)
+        self.assertEqual(s.to_list(), self.expected)
+
+    def test_files_with_path(self):
+        s = Stream.files(self.root / "*.log", ordered=True, with_path=True)
+        path, line = s.first()
+        self.assertEqual((path, line), (self.root / "0.log", "0-0\n"))
+
+    def test_files_recursive_pattern(self):
+        (self.root / "sub").mkdir()
+        (self.root / "sub" / "6.log").write_text("6-0\n")
+        s = Stream.files(self.root / "**" / "*.log", ordered=True)
+        self.assertEqual(s.last(), "6-0\n")
+
+    def test_files_no_match(self):
+        self.assertEqual(Stream.files(self.root / "*.csv").to_list(), [])
+
+    def test_files_bad_max_open(self):
+        with self.assertRaises(ValueError):
+            Stream.files(self.root / "*.log", max_open=0)
+
+    def test_files_bad_buffer_size(self):
+        with self.assertRaises(ValueError):
+            Stream.files(self.root / "*.log", buffer_size=0)
+
+
+class JoinByKeyTest(unittest.TestCase):
+    def setUp(self):
+        self.events = [(1, "click"), (2, "view"), (1, "buy"), (3, "view")]
+        self.users = [(1, "alice"), (2, "bob"), (4, "dave")]
+
+    def test_inner_join_hash(self):
+        s = Stream(self.events).inner_join(self.users, lambda x: x[0])
+        self.assertEqual(
+            s.to_list(),
+            [
+                ((1, "click"), (1, "alice")),
+                ((2, "view"), (2, "bob")),
+                ((1, "buy"), (1, "alice")),
+            ],
+        )
+
+    def test_left_join_hash(self):
+        s = Stream(self.events).left_join(self.users, lambda x: x[0])
+        self.assertEqual(
+            s.to_list(),
+            [
+                ((1, "click"), (1, "alice")),
+                ((2, "view"), (2, "bob")),
+                ((1, "buy"), (1, "alice")),
+                ((3, "view"), None),
+            ],
+        )
+
+    def test_inner_join_with_other_key(self):
+        s = Stream([1, 2, 3]).inner_join(self.users, lambda x: x, lambda x: x[0])
+        self.assertEqual(s.to_list(), [(1, (1, "alice")), (2, (2, "bob"))])
+
+    def test_inner_join_multiple_matches(self):
+        s = Stream([1]).inner_join([(1, "a"), (1, "b")], lambda x: x, lambda x: x[0])
+        self.assertEqual(s.to_list(), [(1, (1, "a")), (1, (1, "b"))])
+
+    def test_inner_join_spills_to_disk(self):
+        left = Stream.range(1000).map(lambda x: x % 300)
+        s = left.inner_join(range(0, 600, 2), lambda x: x, max_build_size=10)
+        self.assertEqual(
+            sorted(s.to_list()), sorted((x % 300, x % 300) for x in range(1000) if x % 2 == 0)
+        )
+
+    def test_left_join_spills_to_disk(self):
+        right = [(x, str(x)) for x in range(0, 50, 5)]
+        s = Stream.range(100).left_join(right, lambda x: x, lambda x: x[0], max_build_size=3)
+        expected = [(x, (x, str(x)) if x % 5 == 0 and x < 50 else None) for x in range(100)]
+        self.assertEqual(sorted(s.to_list(), key=lambda x: x[0]), expected)
+
+    def test_left_join_spills_building_on_left(self):
+        right = [(x % 20, x) for x in range(400)]
+        s = Stream.range(30).left_join(right, lambda x: x, lambda x: x[0], max_build_size=5)
+        result = s.to_list()
+        self.assertEqual(len(result), 400 + 10)
+        self.assertEqual(sorted(x for x, match in result if match is None), list(range(20, 30)))
+
+    def test_oversized_partitions_are_partitioned_again(self):
+        partitions = []
+        join_partition = functions._join_partition
+
+        def record(left_file, right_file, left_count, right_count, outer, max_build_size, depth):
+            partitions.append((min(left_count, right_count), depth))
+            return join_partition(
+                left_file, right_file, left_count, right_count, outer, max_build_size, depth
+            )
+
+        with patch("functions._join_partition", side_effect=record):
+            s = Stream.range(5000).left_join(range(0, 8000, 2), lambda x: x, max_build_size=20)
+            result = s.to_list()
+        self.assertEqual(len(result), 5000)
+        self.assertEqual(sum(match is None for _, match in result), 2500)
+        # Partitions over the limit are partitioned again instead of being built in memory.
+        oversized = [depth for size, depth in partitions if size > 20]
+        self.assertTrue(oversized)
+        self.assertTrue(all(depth < functions._MAX_JOIN_DEPTH for depth in oversized))
+        self.assertTrue(any(depth > 0 for _, depth in partitions))
+
+    def test_skewed_keys_stop_partitioning(self):
+        s = Stream([1] * 200).inner_join([1] * 50, lambda x: x, max_build_size=10)
+        self.assertEqual(len(s.to_list()), 200 * 50)
+
+    def test_inner_join_merge(self):
+        s = Stream(sorted(self.events)).inner_join(self.users, lambda x: x[0], method="merge")
+        self.assertEqual(
+            s.to_list(),
+            [
+                ((1, "buy"), (1, "alice")),
+                ((1, "click"), (1, "alice")),
+                ((2, "view"), (2, "bob")),
+            ],
+        )
+
+    def test_left_join_merge(self):
+        s = Stream([0, 1, 1, 4, 5]).left_join(
+            self.users, lambda x: x, lambda x: x[0], method="merge"
+        )
+        self.assertEqual(
+            s.to_list(),
+            [(0, None), (1, (1, "alice")), (1, (1, "alice")), (4, (4, "dave")), (5, None)],
+        )
+
+    def test_join_unknown_method(self):
+        with self.assertRaises(ValueError):
+            Stream(self.events).inner_join(self.users, lambda x: x[0], method="nested")
+
+
+class MergeSortedTest(unittest.TestCase):
+    def test_merge_sorted_simple(self):
+        s = Stream.merge_sorted([1, 4, 7], [2, 5, 8], [3, 6, 9])
+        self.assertEqual(s.to_list(), list(range(1, 10)))
+
+    def test_merge_sorted_streams(self):
+        s = Stream.merge_sorted(Stream.range(0, 10, 2), Stream.range(1, 10, 2))
+        self.assertEqual(s.to_list(), list(range(10)))
+
+    def test_merge_sorted_with_key(self):
+        s = Stream.merge_sorted(["a", "ccc"], ["bb", "dddd"], key=len)
+        self.assertEqual(s.to_list(), ["a", "bb", "ccc", "dddd"])
+
+    def test_merge_sorted_reverse(self):
+        s = Stream.merge_sorted([9, 5, 1], [8, 2], reverse=True)
+        self.assertEqual(s.to_list(), [9, 8, 5, 2, 1])
+
+    def test_merge_sorted_is_stable(self):
+        s = Stream.merge_sorted([(1, "a"), (2, "a")], [(1, "b")], key=lambda x: x[0])
+        self.assertEqual(s.to_list(), [(1, "a"), (1, "b"), (2, "a")])
+
+    def test_merge_sorted_is_lazy(self):
+        s = Stream.merge_sorted(Stream.range(10**12), Stream.range(10**12))
+        self.assertEqual(s.take(4).to_list(), [0, 0, 1, 1])
+
+    def test_merge_sorted_empty(self):
+        self.assertEqual(Stream.merge_sorted().to_list(), [])
+        self.assertEqual(Stream.merge_sorted([], [1]).to_list(), [1])
+
+
+class ParallelTest(unittest.TestCase):
+    def test_parallel_thread_map(self):
+        s = Stream.range(1000).parallel(thread=4).map(lambda x: x * 2)
+        self.assertEqual(s.to_list(), [x * 2 for x in range(1000)])
+
+    def test_parallel_thread_filter_and_exclude(self):
+        s = (
+            Stream.range(1000)
+            .parallel(thread=2, batch_size=7)
+            .filter(lambda x: x % 2 == 0)
+            .exclude(lambda x: x % 3 == 0)
+        )
+        self.assertEqual(s.to_list(), [x for x in range(1000) if x % 2 == 0 and x % 3])
+
+    def test_parallel_runs_on_pool_threads(self):
+        names = Stream.range(10).parallel(thread=2).map(
+            lambda x: threading.current_thread().name
+        )
+        self.assertTrue(all(name.startswith("streampy") for name in names))
+
+    def test_parallel_process_map(self):
+        s = Stream.range(-500, 500).parallel(process=2).map(abs)
+        self.assertEqual(s.to_list(), [abs(x) for x in range(-500, 500)])
+
+    def test_parallel_mode_survives_other_operations(self):
+        s = (
+            Stream.range(100)
+            .parallel(thread=2)
+            .limit(50)
+            .map(lambda x: threading.current_thread().name)
+        )
+        self.assertTrue(all(name.startswith("streampy") for name in s))
+
+    def test_sequential(self):
+        s = (
+            Stream.range(10)
+            .parallel(thread=2)
+            .map(lambda x: x + 1)
+            .sequential()
+            .map(lambda x: threading.current_thread().name)
+        )
+        self.assertEqual(set(s), {threading.current_thread().name})
+
+    def test_parallel_is_lazy_on_unbounded_source(self):
+        s = Stream.range(10**12).parallel(thread=2).map(lambda x: x + 1)
+        self.assertEqual(s.take(3).to_list(), [1, 2, 3])
+
+    def test_parallel_propagates_exceptions(self):
+        s = Stream([1, 0]).parallel(thread=2).map(lambda x: 1 / x)
+        with self.assertRaises(ZeroDivisionError):
+            s.to_list()
+
+    def test_parallel_bad_arguments(self):
+        with self.assertRaises(ValueError):
+            Stream().parallel(thread=True, process=True)
+        with self.assertRaises(ValueError):
+            Stream().parallel(thread=0)
+        with self.assertRaises(ValueError):
+            Stream().parallel(thread=2, batch_size=0)
+
+
+class PoolsTest(unittest.TestCase):
+    def test_pools_are_shared_across_streams(self):
+        Stream.range(10).parallel(thread=3).map(lambda x: x).to_list()
+        pool = pools.get_pool(pools.THREAD, 3)
+        Stream.range(10).parallel(thread=3).map(lambda x: x).to_list()
+        self.assertIs(pools.get_pool(pools.THREAD, 3), pool)
+
+    def test_warm_up_starts_every_thread(self):
+        pool = pools.warm_up(pools.THREAD, 3)
+        self.assertEqual(len(pool._threads), 3)
+
+    def test_warm_up_imports_modules_in_workers(self):
+        pools.configure(warm_up=["json"])
+        try:
+            pool = pools.warm_up(pools.PROCESS, 2)
+            self.assertEqual(pool.submit(sorted, "ba").result(), ["a", "b"])
+        finally:
+            pools.configure()
+
+    def test_configure_replaces_process_pools(self):
+        pool = pools.get_pool(pools.PROCESS, 2)
+        pools.configure()
+        self.assertIsNot(pools.get_pool(pools.PROCESS, 2), pool)
+
+    @unittest.skipUnless(PROCESS_POOL_RECYCLING, "requires Python 3.11")
+    def test_max_tasks_per_child(self):
+        pools.configure(max_tasks_per_child=1)
+        try:
+            s = Stream.range(-3, 3).parallel(process=1, batch_size=1).map(abs)
+            self.assertEqual(s.to_list(), [3, 2, 1, 0, 1, 2])
+        finally:
+            pools.configure()
+
+    @unittest.skipIf(PROCESS_POOL_RECYCLING, "requires Python older than 3.11")
+    def test_max_tasks_per_child_unsupported(self):
+        with self.assertRaises(ValueError):
+            pools.configure(max_tasks_per_child=1)
+
+    def test_shutdown_recreates_pools_lazily(self):
+        pool = pools.get_pool(pools.THREAD, 2)
+        pools.shutdown()
+        self.assertIsNot(pools.get_pool(pools.THREAD, 2), pool)
+        self.assertEqual(Stream.range(3).parallel(thread=2).map(abs).to_list(), [0, 1, 2])
+
+    def test_unknown_kind(self):
+        with self.assertRaises(ValueError):
+            pools.get_pool("fiber", 2)
+
+
+class AsyncStreamTest(unittest.TestCase):
+    @staticmethod
+    async def agen(count):
+        for item in range(count):
+            await asyncio.sleep(0)
+            yield item
+
+    def test_async_stream_from_async_iterable(self):
+        s = AsyncStream(self.agen(5)).map(lambda x: x * 2)
+        self.assertEqual(asyncio.run(s.to_list()), [0, 2, 4, 6, 8])
+
+    def test_async_stream_from_stream(self):
+        s = Stream.range(5).map(lambda x: x + 1).aiter().filter(lambda x: x % 2)
+        self.assertEqual(asyncio.run(s.to_list()), [1, 3, 5])
+
+    def test_async_map_runs_concurrently(self):
+        running, peak = 0, 0
+
+        async def call(x):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            return x
+
+        s = AsyncStream(range(50)).map(call, max_concurrency=10)
+        self.assertEqual(asyncio.run(s.to_list()), list(range(50)))
+        self.assertEqual(peak, 10)
+
+    def test_async_map_unordered(self):
+        async def call(x):
+            await asyncio.sleep(0.05 if x == 0 else 0)
+            return x
+
+        s = AsyncStream(range(5)).map(call, max_concurrency=5, ordered=False)
+        result = asyncio.run(s.to_list())
+        self.assertEqual(result[-1], 0)
+        self.assertEqual(sorted(result), list(range(5)))
+
+    def test_async_filter_with_coroutine(self):
+        async def even(x):
+            return x % 2 == 0
+
+        s = AsyncStream(range(6)).filter(even)
+        self.assertEqual(asyncio.run(s.to_list()), [0, 2, 4])
+
+    def test_async_chunk(self):
+        s = AsyncStream(self.agen(5)).chunk(2)
+        self.assertEqual(asyncio.run(s.to_list()), [[0, 1], [2, 3], [4]])
+
+    def test_async_distinct(self):
+        s = AsyncStream([1, 2, 1, 3, 2]).distinct()
+        self.assertEqual(asyncio.run(s.to_list()), [1, 2, 3])
+
+    def test_async_take_cancels_in_flight_calls(self):
+        cancelled = []
+
+        async def call(x):
+            try:
+                await asyncio.sleep(0 if x < 2 else 10)
+            except asyncio.CancelledError:
+                cancelled.append(x)
+                raise
+            return x
+
+        async def run():
+            return await AsyncStream(range(10)).map(call, max_concurrency=5).take(2).to_list()
+
+        self.assertEqual(asyncio.run(run()), [0, 1])
+        self.assertEqual(sorted(cancelled), [2, 3, 4])
+
+    def test_async_first(self):
+        self.assertEqual(asyncio.run(AsyncStream(self.agen(3)).first()), 0)
+        self.assertIsNone(asyncio.run(AsyncStream().first()))
+
+    def test_async_map_propagates_exceptions(self):
+        s = AsyncStream([1, 0]).map(lambda x: 1 / x, max_concurrency=2)
+        with self.assertRaises(ZeroDivisionError):
+            asyncio.run(s.to_list())
+
+    def test_async_stream_bad_arguments(self):
+        self.assertRaises(TypeError, AsyncStream, None)
+        self.assertRaises(TypeError, AsyncStream, [], [])
+
+
+class PrefetchTest(unittest.TestCase):
+    def test_prefetch_keeps_items_and_order(self):
+        self.assertEqual(Stream.range(1000).prefetch(10).to_list(), list(range(1000)))
+
+    def test_prefetch_runs_source_on_background_thread(self):
+        s = Stream.range(3).map(lambda x: threading.current_thread()).prefetch(2)
+        self.assertNotIn(threading.current_thread(), s.to_list())
+
+    def test_prefetch_is_bounded(self):
+        pulled = []
+        s = Stream.range(100).peek(pulled.append).prefetch(5)
+        self.assertEqual(s.first(), 0)
+        time.sleep(0.1)
+        self.assertLessEqual(len(pulled), 7)
+
+    def test_prefetch_stops_source_on_early_termination(self):
+        pulled = []
+        s = Stream.range(10**9).peek(pulled.append).prefetch(5)
+        self.assertEqual(s.limit(3).to_list(), [0, 1, 2])
+        del s
+        time.sleep(0.1)
+        count = len(pulled)
+        time.sleep(0.1)
+        self.assertEqual(len(pulled), count)
+
+    def test_prefetch_propagates_exceptions(self):
+        s = Stream([1, 0]).map(lambda x: 1 / x).prefetch(2)
+        with self.assertRaises(ZeroDivisionError):
+            s.to_list()
+
+    def test_prefetch_empty(self):
+        self.assertEqual(Stream().prefetch(1).to_list(), [])
+
+    def test_prefetch_bad_buffer_size(self):
+        with self.assertRaises(ValueError):
+            Stream.range(3).prefetch(0).to_list()
+
+
+class PipelinedStagesTest(unittest.TestCase):
+    def test_stages_keep_items_and_order(self):
+        s = (
+            Stream.range(1000)
+            .parallel(thread=2, batch_size=16)
+            .map(lambda x: x + 1)
+            .parallel(process=2)
+            .map(abs)
+            .parallel(thread=3)
+            .filter(lambda x: x % 2)
+        )
+        self.assertEqual(s.to_list(), list(range(1, 1001, 2)))
+
+    def test_stages_run_simultaneously(self):
+        def slow(x):
+            time.sleep(0.02)
+            return x
+
+        start = time.monotonic()
+        s = (
+            Stream.range(20)
+            .parallel(thread=1, batch_size=1)
+            .map(slow)
+            .parallel(thread=1, batch_size=1)
+            .map(slow)
+        )
+        self.assertEqual(s.to_list(), list(range(20)))
+        # Sequential stages would take 20 * 2 * 0.02 = 0.8 seconds.
+        self.assertLess(time.monotonic() - start, 0.65)
+
+    def test_stage_separated_by_sequential_operation(self):
+        s = (
+            Stream.range(100)
+            .parallel(thread=2)
+            .map(lambda x: x * 2)
+            .limit(10)
+            .parallel(thread=2)
+            .map(lambda x: x + 1)
+        )
+        self.assertEqual(s.to_list(), [x * 2 + 1 for x in range(10)])
+
+    def test_stage_propagates_upstream_exceptions(self):
+        s = (
+            Stream([1, 0])
+            .parallel(thread=2)
+            .map(lambda x: 1 / x)
+            .parallel(thread=2)
+            .map(lambda x: x)
+        )
+        with self.assertRaises(ZeroDivisionError):
+            s.to_list()
+
+
+class UnorderedParallelTest(unittest.TestCase):
+    @staticmethod
+    def slow_first(x):
+        time.sleep(0.2 if x == 0 else 0)
+        return x
+
+    def test_unordered_yields_in_completion_order(self):
+        s = Stream.range(10).parallel(thread=4, batch_size=1, ordered=False).map(
+            self.slow_first
+        )
+        result = s.to_list()
+        self.assertEqual(result[-1], 0)
+        self.assertEqual(sorted(result), list(range(10)))
+
+    def test_unordered_first_is_not_blocked_by_slow_item(self):
+        s = Stream.range(10).parallel(thread=4, batch_size=1, ordered=False).map(
+            self.slow_first
+        )
+        start = time.monotonic()
+        self.assertNotEqual(s.first(), 0)
+        self.assertLess(time.monotonic() - start, 0.15)
+
+    def test_unordered_filter(self):
+        s = Stream.range(1000).parallel(thread=3, ordered=False).filter(lambda x: x % 7 == 0)
+        self.assertEqual(sorted(s.to_list()), list(range(0, 1000, 7)))
+
+    def test_ordered_window_caps_pulled_items(self):
+        pulled = []
+        s = (
+            Stream.range(1000)
+            .peek(pulled.append)
+            .parallel(thread=2, batch_size=1, window=3)
+            .map(self.slow_first)
+        )
+        self.assertEqual(s.first(), 0)
+        self.assertLessEqual(len(pulled), 4)
+
+    def test_ordered_with_window(self):
+        s = Stream.range(100).parallel(thread=4, batch_size=3, window=5).map(lambda x: -x)
+        self.assertEqual(s.to_list(), [-x for x in range(100)])
+
+    def test_bad_window(self):
+        with self.assertRaises(ValueError):
+            Stream().parallel(thread=2, window=0)
+
+
+class ParallelCancellationTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+    def slow(self, x):
+        self.calls.append(x)
+        time.sleep(0.01)
+        if x == 5:
+            raise ValueError(x)
+        return x
+
+    def test_first_on_unbounded_source_returns_quickly(self):
+        start = time.monotonic()
+        value = Stream.range(10**9).parallel(process=2).map(abs).first()
+        self.assertEqual(value, 0)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_first_cancels_pending_batches(self):
+        self.assertEqual(
+            Stream.range(10**9).parallel(thread=1, batch_size=1, window=50).map(self.slow).first(),
+            0,
+        )
+        time.sleep(0.1)
+        self.assertLess(len(self.calls), 10)
+
+    def test_limit_cancels_pending_batches(self):
+        s = Stream.range(10**9).parallel(thread=1, batch_size=1, window=50).map(self.slow)
+        self.assertEqual(s.limit(2).to_list(), [0, 1])
+        del s
+        time.sleep(0.1)
+        self.assertLess(len(self.calls), 10)
+
+    def test_exception_cancels_pending_batches(self):
+        s = Stream.range(10**9).parallel(thread=1, batch_size=1, window=50).map(self.slow)
+        with self.assertRaises(ValueError):
+            s.to_list()
+        del s
+        time.sleep(0.1)
+        self.assertLess(len(self.calls), 10)
+
+    def test_unordered_exception_cancels_pending_batches(self):
+        s = Stream.range(10**9).parallel(
+            thread=1, batch_size=1, window=50, ordered=False
+        ).map(self.slow)
+        with self.assertRaises(ValueError):
+            s.to_list()
+        del s
+        time.sleep(0.1)
+        self.assertLess(len(self.calls), 10)
+
+
+class AdaptiveBatchTest(unittest.TestCase):
+    def test_auto_batch_grows_for_cheap_functions(self):
+        s = Stream.range(100000).parallel(thread=2).map(lambda x: x + 1)
+        self.assertEqual(s.to_list(), list(range(1, 100001)))
+        profile = s.profile()[0]
+        self.assertEqual(profile["operation"], "map")
+        self.assertGreater(profile["batch_size"], 64)
+        self.assertEqual(profile["batch_sizes"][0], 8)
+
+    def test_auto_batch_stays_small_for_expensive_functions(self):
+        def slow(x):
+            time.sleep(0.01)
+            return x
+
+        s = Stream.range(40).parallel(thread=4).map(slow)
+        self.assertEqual(s.to_list(), list(range(40)))
+        self.assertLessEqual(s.profile()[0]["batch_size"], 4)
+
+    def test_fixed_batch_size_is_pinned(self):
+        s = Stream.range(1000).parallel(thread=2, batch_size=10).filter(lambda x: x % 2)
+        s.to_list()
+        profile = s.profile()[0]
+        self.assertEqual(profile["batch_sizes"], [10])
+        self.assertEqual(profile["tasks"], 100)
+        self.assertIsNotNone(profile["item_cost"])
+        self.assertIsNotNone(profile["task_overhead"])
+
+    def test_profile_lists_every_parallel_operation(self):
+        s = (
+            Stream.range(100)
+            .parallel(thread=2)
+            .map(lambda x: x)
+            .parallel(process=2)
+            .map(abs)
+            .sequential()
+            .map(lambda x: x)
+        )
+        s.to_list()
+        self.assertEqual(
+            [(p["kind"], p["slot"]) for p in s.profile()], [("thread", 0), ("process", 1)]
+        )
+
+    def test_profile_of_sequential_stream(self):
+        self.assertEqual(Stream.range(3).map(abs).profile(), [])
+
+    def test_bad_batch_size(self):
+        with self.assertRaises(ValueError):
+            Stream().parallel(thread=2, batch_size="large")
+
+
+class ParallelReduceTest(unittest.TestCase):
+    def test_parallel_reduce_sum(self):
+        s = Stream.range(100000).parallel(thread=4)
+        self.assertEqual(s.reduce(operator.add, 0, combiner=operator.add), sum(range(100000)))
+
+    def test_parallel_reduce_with_mutating_accumulator(self):
+        def append(accumulator, item):
+            accumulator.append(item)
+            return accumulator
+
+        s = Stream.range(1000).parallel(thread=4, batch_size=100)
+        self.assertEqual(s.reduce(append, [], combiner=operator.add), list(range(1000)))
+        s = Stream.range(1000).parallel(thread=4, batch_size=100)
+        self.assertEqual(s.reduce(lambda a, x: a.add(x % 10) or a, set(), combiner=operator.or_), set(range(10)))
+        counts = Stream(["a", "b", "a"] * 100).parallel(thread=4, batch_size=7).reduce(
+            lambda counter, x: counter.update(x) or counter, Counter(), combiner=operator.add
+        )
+        self.assertEqual(counts, Counter({"a": 200, "b": 100}))
+
+    def test_parallel_reduce_in_processes(self):
+        s = Stream.range(10000).parallel(process=2, batch_size=100)
+        self.assertEqual(s.reduce(operator.add, 0, combiner=operator.add), sum(range(10000)))
+
+    def test_parallel_reduce_counters(self):
+        words = ["a", "b", "a", "c", "b", "a"] * 100
+        s = Stream(words).parallel(thread=3, batch_size=7)
+        result = s.reduce(
+            lambda counter, word: counter + Counter([word]), Counter(), combiner=operator.add
+        )
+        self.assertEqual(result, Counter(words))
+
+    def test_parallel_reduce_keeps_order(self):
+        s = Stream("abcdefghijklmnopqrstuvwxyz").parallel(thread=4, batch_size=3)
+        self.assertEqual(
+            s.reduce(operator.add, combiner=operator.add), "abcdefghijklmnopqrstuvwxyz"
+        )
+
+    def test_parallel_reduce_without_initial(self):
+        s = Stream.range(1, 11).parallel(thread=2, batch_size=3)
+        self.assertEqual(s.reduce(operator.mul, combiner=operator.mul), 3628800)
+
+    def test_parallel_reduce_empty(self):
+        s = Stream().parallel(thread=2)
+        self.assertEqual(s.reduce(operator.add, 0, combiner=operator.add), 0)
+        with self.assertRaises(TypeError):
+            Stream().parallel(thread=2).reduce(operator.add, combiner=operator.add)
+
+    def test_parallel_reduce_runs_on_workers(self):
+        s = Stream.range(100).parallel(thread=2, batch_size=10)
+        names = s.reduce(
+            lambda names, _: names | {threading.current_thread().name},
+            frozenset(),
+            combiner=operator.or_,
+        )
+        self.assertTrue(all(name.startswith("streampy") for name in names))
+
+    def test_combiner_ignored_in_sequential_mode(self):
+        self.assertEqual(Stream.range(5).reduce(operator.add, combiner=operator.mul), 10)
+
+
+class AggregateByTest(unittest.TestCase):
+    def setUp(self):
+        self.words = ["apple", "banana", "avocado", "cherry", "blueberry", "apricot"] * 50
+
+    def test_aggregate_by_sequential(self):
+        result = Stream(self.words).aggregate_by(lambda x: x[0], lambda total, x: total + len(x), 0)
+        self.assertEqual(result, {"a": 950, "b": 750, "c": 300})
+
+    def test_aggregate_by_parallel(self):
+        result = (
+            Stream(self.words)
+            .parallel(thread=3, batch_size=7)
+            .aggregate_by(lambda x: x[0], lambda total, x: total + len(x), 0, operator.add)
+        )
+        self.assertEqual(result, {"a": 950, "b": 750, "c": 300})
+
+    def test_aggregate_by_copies_mutable_initial(self):
+        def collect(items, x):
+            items.append(x)
+            return items
+
+        result = Stream.range(10).aggregate_by(lambda x: x % 2, collect, [])
+        self.assertEqual(result, {0: [0, 2, 4, 6, 8], 1: [1, 3, 5, 7, 9]})
+
+    def test_count_by_sequential(self):
+        self.assertEqual(Stream("abracadabra").count_by(lambda x: x), Counter("abracadabra"))
+
+    def test_count_by_parallel_threads(self):
+        s = Stream.range(100000).parallel(thread=4)
+        self.assertEqual(s.count_by(lambda x: x % 10), {key: 10000 for key in range(10)})
+
+    def test_count_by_parallel_processes(self):
+        s = Stream.range(-500, 500).parallel(process=2, batch_size=50)
+        self.assertEqual(s.count_by(abs), Counter(abs(x) for x in range(-500, 500)))
+
+    def test_count_by_many_partials(self):
+        s = Stream.range(5000).parallel(thread=2, batch_size=10)
+        self.assertEqual(s.count_by(lambda x: x % 1000), {key: 5 for key in range(1000)})
+
+    def test_count_by_empty(self):
+        self.assertEqual(Stream().parallel(thread=2).count_by(lambda x: x), {})
+
+    def test_workers_split_partials_by_key_hash(self):
+        aggregator = (str.lower, functions._increment, 0, 3)
+        (parts,) = functions._split_aggregate_batch(aggregator, ["a", "B", "b", "c", "A"])
+        self.assertEqual(len(parts), 3)
+        for index, part in enumerate(parts):
+            self.assertTrue(all(hash(key) % 3 == index for key in part))
+        self.assertEqual({k: v for part in parts for k, v in part.items()}, {"a": 2, "b": 2, "c": 1})
+
+    def test_merge_tolerates_keys_in_several_partitions(self):
+        pool = pools.get_pool(pools.THREAD, 2)
+        partials = [[{"a": 1}, {}], [{}, {"a": 2, "b": 3}]]
+        self.assertEqual(
+            functions._partitioned_merge(pool, operator.add, partials, 2), {"a": 3, "b": 3}
+        )
+
+
+class ParallelSortTest(unittest.TestCase):
+    def setUp(self):
+        generator = random.Random(42)
+        self.items = [generator.randrange(1000) for _ in range(20000)]
+
+    def test_parallel_sort(self):
+        s = Stream(self.items).parallel(thread=4).sort()
+        self.assertEqual(s.to_list(), sorted(self.items))
+
+    def test_parallel_sorted_reverse(self):
+        s = Stream(self.items).parallel(thread=4).sorted(reverse=True)
+        self.assertEqual(s.to_list(), sorted(self.items, reverse=True))
+
+    def test_parallel_sort_with_key_is_stable(self):
+        pairs = list(enumerate(self.items))
+        s = Stream(pairs).parallel(thread=3).sort(key=lambda x: x[1] % 10)
+        self.assertEqual(s.to_list(), sorted(pairs, key=lambda x: x[1] % 10))
+
+    def test_parallel_sort_reverse_with_key_is_stable(self):
+        pairs = list(enumerate(self.items))
+        s = Stream(pairs).parallel(thread=3).sort(key=lambda x: x[1] % 10, reverse=True)
+        self.assertEqual(s.to_list(), sorted(pairs, key=lambda x: x[1] % 10, reverse=True))
+
+    def test_parallel_sort_in_processes(self):
+        s = Stream(self.items).parallel(process=2).sorted(key=operator.neg)
+        self.assertEqual(s.to_list(), sorted(self.items, key=operator.neg))
+
+    def test_parallel_sort_all_equal(self):
+        s = Stream([(1, i) for i in range(5000)]).parallel(thread=4).sort(key=lambda x: x[0])
+        self.assertEqual(s.to_list(), [(1, i) for i in range(5000)])
+
+    def test_parallel_sort_small_input(self):
+        self.assertEqual(Stream([3, 1, 2]).parallel(thread=4).sort().to_list(), [1, 2, 3])
+        self.assertEqual(Stream().parallel(thread=4).sort().to_list(), [])
+
+    def test_parallel_sort_keeps_parallel_mode(self):
+        s = Stream(self.items).parallel(thread=2).sort().map(
+            lambda x: threading.current_thread().name
+        )
+        self.assertTrue(all(name.startswith("streampy") for name in s.to_list()))
+
+
+class ParallelDistinctTest(unittest.TestCase):
+    def setUp(self):
+        generator = random.Random(7)
+        self.items = [generator.randrange(500) for _ in range(20000)]
+
+    def test_parallel_distinct_keeps_first_occurrences(self):
+        s = Stream(self.items).parallel(thread=4).distinct()
+        self.assertEqual(s.to_list(), list(dict.fromkeys(self.items)))
+
+    def test_parallel_distinct_with_predicate(self):
+        s = Stream(self.items).parallel(thread=3, batch_size=100).distinct(lambda x: x % 50)
+        self.assertEqual(
+            s.to_list(), Stream(self.items).distinct(lambda x: x % 50).to_list()
+        )
+
+    def test_parallel_distinct_by_in_processes(self):
+        items = [x - 250 for x in self.items]
+        s = Stream(items).parallel(process=2).distinct_by(abs)
+        self.assertEqual(s.to_list(), Stream(items).distinct_by(abs).to_list())
+
+    def test_parallel_distinct_unordered(self):
+        s = Stream(self.items).parallel(thread=4, batch_size=64).distinct(ordered=False)
+        result = s.to_list()
+        self.assertEqual(len(result), len(set(result)))
+        self.assertEqual(set(result), set(self.items))
+
+    def test_parallel_distinct_by_unordered_keeps_one_per_key(self):
+        s = Stream(self.items).parallel(thread=4).distinct_by(lambda x: x % 7, ordered=False)
+        self.assertEqual(sorted(x % 7 for x in s.to_list()), list(range(7)))
+
+    def test_parallel_distinct_is_lazy(self):
+        s = Stream.range(10**12).parallel(thread=2, batch_size=10).distinct()
+        self.assertEqual(s.take(5).to_list(), [0, 1, 2, 3, 4])
+
+    def test_parallel_distinct_empty(self):
+        self.assertEqual(Stream().parallel(thread=2).distinct().to_list(), [])
+
+    def test_parallel_distinct_with_gil_keeps_seen_keys_on_consumer(self):
+        with patch("streampy.FREE_THREADING", False), patch("streampy._sharded_distinct") as sharded:
+            s = Stream(self.items).parallel(thread=4).distinct()
+            self.assertEqual(s.to_list(), list(dict.fromkeys(self.items)))
+            s = Stream(self.items).parallel(process=2).distinct_by(operator.neg)
+            self.assertEqual(s.to_list(), list(dict.fromkeys(self.items)))
+        sharded.assert_not_called()
+
+    def test_parallel_distinct_free_threaded_uses_shared_lanes(self):
+        with patch("streampy.FREE_THREADING", True):
+            s = Stream(self.items).parallel(thread=3, batch_size=100).distinct()
+            self.assertEqual(s.to_list(), list(dict.fromkeys(self.items)))
+            s = Stream(self.items).parallel(thread=3).distinct_by(lambda x: x % 50, ordered=False)
+            self.assertEqual(sorted(x % 50 for x in s.to_list()), list(range(50)))
+        lanes = pools.get_lanes(3)
+        self.assertEqual(len(set(map(id, lanes))), 3)
+        self.assertIs(pools.get_lanes(3)[0], lanes[0])
+
+
+class SharedMemoryTransportTest(unittest.TestCase):
+    def setUp(self):
+        self.payloads = [bytes([i]) * (100000 + i) for i in range(20)]
+
+    def test_shared_memory_bytes(self):
+        s = Stream(self.payloads).parallel(process=2, batch_size=4, shared_memory=True).map(len)
+        self.assertEqual(s.to_list(), [len(p) for p in self.payloads])
+
+    def test_shared_memory_large_results(self):
+        s = Stream(self.payloads).parallel(process=2, batch_size=3, shared_memory=1024).map(
+            bytes.upper
+        )
+        self.assertEqual(s.to_list(), self.payloads)
+
+    def test_shared_memory_bytearray_memoryview_and_tuples(self):
+        items = [
+            bytearray(b"x" * 70000),
+            memoryview(b"y" * 70000),
+            ("key", b"z" * 70000),
+            b"small",
+        ]
+        s = Stream(items).parallel(process=2, shared_memory=True).map(type)
+        self.assertEqual(s.to_list(), [bytearray, memoryview, tuple, bytes])
+        s = Stream(items[:2]).parallel(process=2, shared_memory=True).map(bytes)
+        self.assertEqual(s.to_list(), [b"x" * 70000, b"y" * 70000])
+
+    @unittest.skipUnless(os.path.isdir("/dev/shm"), "needs /dev/shm")
+    def test_uncollected_results_released(self):
+        before = set(os.listdir("/dev/shm"))
+        for _ in range(3):
+            items = (bytes(200000) for _ in range(100))
+            s = Stream(items).parallel(process=2, shared_memory=True, batch_size=4).map(bytes)
+            self.assertEqual(s.first(), bytes(200000))
+            del s
+        deadline = time.monotonic() + 5
+        while set(os.listdir("/dev/shm")) - before and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(set(os.listdir("/dev/shm")) - before, set())
+
+    def test_memoryview_results_viewing_the_input(self):
+        items = [memoryview(bytes([i]) * 100000) for i in range(6)]
+        s = Stream(items).parallel(process=2, shared_memory=True, batch_size=2).map(lambda m: m)
+        self.assertEqual([bytes(m) for m in s.to_list()], [bytes(m) for m in items])
+        s = Stream(items).parallel(process=2, shared_memory=1024, batch_size=2).map(lambda m: m[:5000])
+        self.assertEqual([bytes(m) for m in s.to_list()], [bytes(m[:5000]) for m in items])
+
+    def test_run_shared_closes_input_segment(self):
+        payload, segment = transport.share([memoryview(b"a" * 100000)], 1024)
+        try:
+            for _ in range(2):
+                result = transport.run_shared((functions._map_batch, lambda m: m, 1024), payload)
+                self.assertEqual(transport.unshare(result), [b"a" * 100000])
+                self.assertEqual(transport._lingering, [])
+        finally:
+            transport.release(segment)
+
+    def test_share_round_trip(self):
+        payload, segment = transport.share([b"a" * 10, b"b" * 100, memoryview(b"c" * 100)], 50)
+        self.assertIsNotNone(payload.name)
+        self.assertEqual(payload.sizes, (100, 100))
+        result = transport.run_shared((functions._map_batch, bytes, 50), payload)
+        transport.release(segment)
+        self.assertEqual(transport.unshare(result), [b"a" * 10, b"b" * 100, b"c" * 100])
+
+    def test_share_without_large_buffers(self):
+        payload, segment = transport.share([1, b"small"], 1024)
+        self.assertIsNone(segment)
+        self.assertEqual(transport.unshare(payload), [1, b"small"])
+
+    def test_shared_memory_ignored_by_threads(self):
+        s = Stream(self.payloads).parallel(thread=2, shared_memory=True).map(len)
+        self.assertEqual(s.to_list(), [len(p) for p in self.payloads])
+
+
+class ShipFunctionTest(unittest.TestCase):
+    def test_lambda_map_and_filter_in_processes(self):
+        s = Stream.range(100).parallel(process=2).map(lambda x: x * 3).filter(lambda x: x % 2 == 0)
+        self.assertEqual(s.to_list(), [x * 3 for x in range(100) if x * 3 % 2 == 0])
+
+    def test_closure_in_processes(self):
+        offset = 7
+        factor = {"value": 2}
+        s = Stream.range(50).parallel(process=2).map(lambda x: x * factor["value"] + offset)
+        self.assertEqual(s.to_list(), [x * 2 + 7 for x in range(50)])
+
+    def test_nested_recursive_function_and_globals(self):
+        def factorial(n):
+            return 1 if n <= 1 else n * factorial(n - 1)
+
+        s = Stream.range(10).parallel(process=2).map(lambda x: operator.mod(factorial(x), 1000))
+        self.assertEqual(s.to_list(), [_factorial(x) % 1000 for x in range(10)])
+
+    def test_reduce_aggregate_and_sort_with_lambdas(self):
+        items = [random.randrange(1000) for _ in range(2000)]
+        total = Stream(items).parallel(process=2).reduce(lambda a, b: a + b, 0, combiner=lambda a, b: a + b)
+        self.assertEqual(total, sum(items))
+        counts = Stream(items).parallel(process=2).aggregate_by(
+            lambda x: x % 3, lambda a, x: a + 1, 0, combiner=lambda a, b: a + b
+        )
+        self.assertEqual(counts, dict(Counter(x % 3 for x in items)))
+        ordered = Stream(items).parallel(process=2).sorted(key=lambda x: -x).to_list()
+        self.assertEqual(ordered, sorted(items, key=lambda x: -x))
+
+    def test_defaults_and_kwdefaults(self):
+        def scale(x, factor=3, *, shift=1):
+            return x * factor + shift
+
+        s = Stream.range(20).parallel(process=2).map(scale)
+        self.assertEqual(s.to_list(), [x * 3 + 1 for x in range(20)])
+
+    def test_importable_function_is_not_copied(self):
+        self.assertIs(transport.ship(abs), abs)
+        self.assertIsInstance(transport.ship(lambda x: x), transport._Shipped)
+
+    def test_main_definitions_after_pool_started(self):
+        self.assertEqual(Stream.range(4).parallel(process=2).map(abs).to_list(), [0, 1, 2, 3])
+        source = (
+            "def fact(n):\n"
+            "    return 1 if n <= 1 else n * fact(n - 1)\n"
+            "def kw(x, y=0):\n"
+            "    return x + y\n"
+            "class Point:\n"
+            "    def __init__(self, x):\n"
+            "        self.x = x\n"
+            "    def norm(self):\n"
+            "        return fact(self.x)\n"
+        )
+        namespace = {"__name__": "__main__"}
+        exec(source, namespace)
+        main = sys.modules["__main__"]
+        names = ["fact", "kw", "Point"]
+        for name in names:
+            setattr(main, name, namespace[name])
+        try:
+            fact, kw, point = namespace["fact"], namespace["kw"], namespace["Point"]
+            s = Stream.range(6).parallel(process=2).map(fact)
+            self.assertEqual(s.to_list(), [1, 1, 2, 6, 24, 120])
+            s = Stream.range(3).parallel(process=2).map(lambda x: kw(x, y=1))
+            self.assertEqual(s.to_list(), [1, 2, 3])
+            s = Stream.range(5).parallel(process=2).map(lambda x: point(x).norm())
+            self.assertEqual(s.to_list(), [1, 1, 2, 6, 24])
+        finally:
+            for name in names:
+                delattr(main, name)
+
+    def test_unshippable_function_raises(self):
+        lock = threading.Lock()
+        with self.assertRaises(TypeError) as context:
+            Stream.range(10).parallel(process=2).map(lambda x: lock and x)
+        self.assertIn("Cannot ship", str(context.exception))
+
+    def test_lambda_with_shared_memory(self):
+        s = Stream([b"a" * 70000, b"b"]).parallel(process=2, shared_memory=True).map(lambda b: b[:2])
+        self.assertEqual(s.to_list(), [b"aa", b"b"])
+
+
+def _factorial(n):
+    return 1 if n <= 1 else n * _factorial(n - 1)
+
+
+class FreeThreadingTest(unittest.TestCase):
+    def test_default_kind_follows_interpreter(self):
+        s = Stream.range(100).parallel().map(abs)
+        self.assertEqual(s.to_list(), list(range(100)))
+        kind = s.profile()[0]["kind"]
+        self.assertEqual(kind, pools.THREAD if FREE_THREADING else pools.PROCESS)
+
+    def test_default_kind_when_free_threaded(self):
+        with patch("streampy.FREE_THREADING", True):
+            s = Stream.range(10).parallel().map(lambda x: x + 1)
+            self.assertEqual(s.to_list(), list(range(1, 11)))
+            self.assertEqual(s.profile()[0]["kind"], pools.THREAD)
+        with patch("streampy.FREE_THREADING", False):
+            s = Stream.range(10).parallel().map(abs)
+            self.assertEqual(s.profile()[0]["kind"], pools.PROCESS)
+
+    def test_parallel_group_by_keeps_order(self):
+        items = [random.randrange(100) for _ in range(5000)]
+        expected = {}
+        for item in items:
+            expected.setdefault(item % 7, []).append(item)
+        grouped = Stream(items).parallel(thread=4, batch_size=50).group_by(lambda x: x % 7)
+        self.assertEqual(grouped, expected)
+
+    def test_parallel_group_by_in_processes(self):
+        grouped = Stream.range(1000).parallel(process=2).group_by(lambda x: x % 3)
+        self.assertEqual(grouped, {k: list(range(k, 1000, 3)) for k in range(3)})
+
+    def test_parallel_group_by_unordered(self):
+        grouped = Stream.range(1000).parallel(thread=4, ordered=False).group_by(lambda x: x % 2)
+        self.assertEqual(
+            {k: sorted(v) for k, v in grouped.items()},
+            {0: list(range(0, 1000, 2)), 1: list(range(1, 1000, 2))},
+        )
+
+    def test_parallel_group_by_empty(self):
+        self.assertEqual(Stream([]).parallel(thread=2).group_by(abs), {})
+
+
+class SharedTest(unittest.TestCase):
+    def test_views_split_items(self):
+        views = Stream.range(1000).shared(4, batch_size=10)
+        self.assertEqual(len(views), 4)
+        self.assertIsInstance(views[0], Stream)
+        items = views[0].to_list() + views[1].to_list() + views[2].to_list() + views[3].to_list()
+        self.assertEqual(sorted(items), list(range(1000)))
+
+    def test_concurrent_consumers(self):
+        views = Stream.range(100000).shared(8)
+        results = [None] * len(views)
+
+        def consume(index):
+            results[index] = views[index].map(lambda x: x * 2).to_list()
+
+        threads = [threading.Thread(target=consume, args=(i,)) for i in range(len(views))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        merged = [item for result in results for item in result]
+        self.assertEqual(sorted(merged), [x * 2 for x in range(100000)])
+        for result in results:
+            self.assertEqual(result, sorted(result))
+
+    def test_source_pulled_in_batches(self):
+        pulled = []
+
+        def source():
+            for item in range(10):
+                pulled.append(item)
+                yield item
+
+        first, second = Stream(source()).shared(2, batch_size=4)
+        first_items, second_items = iter(first), iter(second)
+        self.assertEqual(next(first_items), 0)
+        self.assertEqual(pulled, [0, 1, 2, 3])
+        self.assertEqual(next(second_items), 4)
+        self.assertEqual(list(first_items), [1, 2, 3, 8, 9])
+        self.assertEqual(list(second_items), [5, 6, 7])
+
+    def test_source_error_raised_once(self):
+        def source():
+            yield 1
+            raise RuntimeError("broken")
+
+        first, second = Stream(source()).shared(2, batch_size=4)
+        with self.assertRaises(RuntimeError):
+            first.to_list()
+        self.assertEqual(second.to_list(), [])
+
+    def test_bad_arguments(self):
+        with self.assertRaises(ValueError):
+            Stream.range(10).shared(0)
+        with self.assertRaises(ValueError):
+            Stream.range(10).shared(2, batch_size=0)
+
+
+class MapConcurrentTest(unittest.TestCase):
+    def test_results_keep_order(self):
+        def call(x):
+            time.sleep(random.random() / 1000)
+            return x * 2
+
+        s = Stream.range(200).map_concurrent(call, max_in_flight=20)
+        self.assertEqual(s.to_list(), [x * 2 for x in range(200)])
+        self.assertEqual(s.errors, [])
+
+    def test_calls_overlap(self):
+        start = time.perf_counter()
+        s = Stream.range(20).map_concurrent(lambda x: time.sleep(0.05) or x, max_in_flight=20)
+        self.assertEqual(s.to_list(), list(range(20)))
+        self.assertLess(time.perf_counter() - start, 0.5)
+
+    def test_max_in_flight(self):
+        lock = threading.Lock()
+        state = {"running": 0, "peak": 0}
+
+        def call(x):
+            with lock:
+                state["running"] += 1
+                state["peak"] = max(state["peak"], state["running"])
+            time.sleep(0.005)
+            with lock:
+                state["running"] -= 1
+            return x
+
+        Stream.range(50).map_concurrent(call, max_in_flight=3).to_list()
+        self.assertLessEqual(state["peak"], 3)
+
+    def test_errors_raise(self):
+        def call(x):
+            if x == 5:
+                raise KeyError(x)
+            return x
+
+        with self.assertRaises(KeyError):
+            Stream.range(10).map_concurrent(call).to_list()
+
+    def test_errors_skip_and_collect(self):
+        def call(x):
+            if x % 4 == 0:
+                raise KeyError(x)
+            return x
+
+        s = Stream.range(10).map_concurrent(call, on_error="skip")
+        self.assertEqual(s.to_list(), [1, 2, 3, 5, 6, 7, 9])
+        self.assertEqual(s.errors, [])
+        s = Stream.range(10).map_concurrent(call, on_error="collect")
+        self.assertEqual(s.to_list(), [1, 2, 3, 5, 6, 7, 9])
+        self.assertEqual([item for item, _ in s.errors], [0, 4, 8])
+        self.assertIsInstance(s.errors[0][1], KeyError)
+
+    def test_timeout(self):
+        release = threading.Event()
+
+        def call(x):
+            if x == 2:
+                release.wait(5)
+            return x
+
+        start = time.perf_counter()
+        s = Stream.range(6).map_concurrent(call, max_in_flight=4, timeout=0.1, on_error="collect")
+        self.assertEqual(s.to_list(), [0, 1, 3, 4, 5])
+        self.assertLess(time.perf_counter() - start, 2)
+        self.assertEqual(len(s.errors), 1)
+        self.assertEqual(s.errors[0][0], 2)
+        self.assertIsInstance(s.errors[0][1], TimeoutError)
+        release.set()
+
+        with self.assertRaises(TimeoutError):
+            Stream([1]).map_concurrent(lambda x: time.sleep(0.3), timeout=0.05).to_list()
+
+    def test_hung_calls_do_not_stall_following_items(self):
+        release = threading.Event()
+
+        def call(x):
+            if x < 2:
+                release.wait(5)
+            else:
+                time.sleep(0.01)
+            return x
+
+        s = Stream.range(10).map_concurrent(call, max_in_flight=2, timeout=0.2, on_error="collect")
+        self.assertEqual(s.to_list(), list(range(2, 10)))
+        self.assertEqual([item for item, _ in s.errors], [0, 1])
+        release.set()
+
+    def test_timeout_counts_from_start_of_call(self):
+        release = threading.Event()
+
+        def call(x):
+            if x == 0:
+                release.wait(5)
+            else:
+                time.sleep(0.05)
+            return x
+
+        s = Stream.range(6).map_concurrent(call, max_in_flight=1, timeout=0.2, on_error="collect")
+        self.assertEqual(s.to_list(), [1, 2, 3, 4, 5])
+        self.assertEqual([item for item, _ in s.errors], [0])
+        release.set()
+
+    def test_bad_arguments(self):
+        with self.assertRaises(ValueError):
+            Stream.range(10).map_concurrent(abs, max_in_flight=0)
+        with self.assertRaises(ValueError):
+            Stream.range(10).map_concurrent(abs, timeout=0)
+        with self.assertRaises(ValueError):
+            Stream.range(10).map_concurrent(abs, on_error="ignore")
+
+
+class MapWithResourceTest(unittest.TestCase):
+    class Client:
+        created = []
+
+        def __init__(self):
+            self.closed = False
+            self.thread = threading.get_ident()
+            self.created.append(self)
+
+        def call(self, item):
+            self.assert_usable()
+            return item * 2
+
+        def assert_usable(self):
+            if self.closed or self.thread != threading.get_ident():
+                raise RuntimeError("client used after close or from another thread")
+
+        def close(self):
+            self.closed = True
+
+    def setUp(self):
+        self.Client.created = []
+
+    def test_single_resource_on_consumer(self):
+        s = Stream.range(100).map_with_resource(lambda client, x: client.call(x), self.Client)
+        self.assertEqual(s.to_list(), [x * 2 for x in range(100)])
+        self.assertEqual(len(self.Client.created), 1)
+        self.assertTrue(self.Client.created[0].closed)
+
+    def test_resource_per_thread(self):
+        def call(client, x):
+            time.sleep(0.001)
+            return client.call(x)
+
+        s = Stream.range(200).map_with_resource(call, self.Client, pool_size=4)
+        self.assertEqual(s.to_list(), [x * 2 for x in range(200)])
+        self.assertGreaterEqual(len(self.Client.created), 1)
+        self.assertLessEqual(len(self.Client.created), 4)
+        self.assertTrue(all(client.closed for client in self.Client.created))
+
+    def test_resources_closed_on_early_stop(self):
+        s = Stream.range(1000).map_with_resource(lambda client, x: client.call(x), self.Client, pool_size=2)
+        iterator = iter(s)
+        self.assertEqual(next(iterator), 0)
+        iterator.close()
+        self.assertTrue(all(client.closed for client in self.Client.created))
+
+    def test_resources_closed_on_error(self):
+        def call(client, x):
+            if x == 10:
+                raise KeyError(x)
+            return client.call(x)
+
+        with self.assertRaises(KeyError):
+            Stream.range(100).map_with_resource(call, self.Client, pool_size=3).to_list()
+        self.assertTrue(all(client.closed for client in self.Client.created))
+
+    def test_custom_close_and_lazy_creation(self):
+        closed = []
+        s = Stream([]).map_with_resource(lambda r, x: x, list, close=closed.append)
+        self.assertEqual(s.to_list(), [])
+        self.assertEqual(closed, [])
+        s = Stream([1, 2]).map_with_resource(lambda r, x: r.append(x) or len(r), list, close=closed.append)
+        self.assertEqual(s.to_list(), [1, 2])
+        self.assertEqual(closed, [[1, 2]])
+
+    def test_bad_pool_size(self):
+        with self.assertRaises(ValueError):
+            Stream.range(10).map_with_resource(lambda r, x: x, list, pool_size=0)
+
+
+class MemoMapTest(unittest.TestCase):
+    def test_memoizes_repeated_elements(self):
+        calls = []
+
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        items = [1, 2, 1, 3, 2, 1]
+        s = Stream(items).memo_map(square)
+        self.assertEqual(s.to_list(), [1, 4, 1, 9, 4, 1])
+        self.assertEqual(calls, [1, 2, 3])
+        info = s.cache_info()
+        self.assertEqual((info.hits, info.misses, info.disk_hits), (3, 3, 0))
+        self.assertEqual(
+            repr(info), "CacheInfo(hits=3, misses=3, disk_hits=0, maxsize=1024, currsize=3)"
+        )
+        self.assertEqual((info.maxsize, info.currsize), (1024, 3))
+
+    def test_lru_eviction(self):
+        calls = []
+
+        def ident(x):
+            calls.append(x)
+            return x
+
+        s = Stream([1, 2, 1, 3, 2, 1]).memo_map(ident, size=2)
+        self.assertEqual(s.to_list(), [1, 2, 1, 3, 2, 1])
+        # 2 is evicted by 3 since 1 was used more recently, then 1 is evicted by 2.
+        self.assertEqual(calls, [1, 2, 3, 2, 1])
+        self.assertEqual(s.cache_info().currsize, 2)
+
+    def test_persistent_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = pathlib.Path(directory) / "memo.sqlite"
+            calls = []
+
+            def upper(x):
+                calls.append(x)
+                return x.upper()
+
+            s = Stream(["a", "b", "a"]).memo_map(upper, path=path)
+            self.assertEqual(s.to_list(), ["A", "B", "A"])
+            s = Stream(["b", "c", "a"]).memo_map(upper, path=str(path))
+            self.assertEqual(s.to_list(), ["B", "C", "A"])
+            self.assertEqual(calls, ["a", "b", "c"])
+            info = s.cache_info()
+            self.assertEqual((info.hits, info.misses, info.disk_hits), (2, 1, 2))
+
+    def test_persistent_cache_saved_on_early_stop(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = pathlib.Path(directory) / "memo.sqlite"
+            iterator = iter(Stream.range(10).memo_map(str, path=path))
+            self.assertEqual(next(iterator), "0")
+            iterator.close()
+            s = Stream([0]).memo_map(lambda x: self.fail("not cached"), path=path)
+            self.assertEqual(s.to_list(), ["0"])
+
+    def test_bad_size(self):
+        with self.assertRaises(ValueError):
+            Stream.range(10).memo_map(str, size=0)
+
+
+class TimedChunkTest(unittest.TestCase):
+    def trickle(self, delays):
+        for item, delay in enumerate(delays):
+            time.sleep(delay)
+            yield item
+
+    def test_full_chunks_when_source_is_fast(self):
+        s = Stream.range(10).chunk(3, max_wait=5)
+        self.assertEqual(s.to_list(), [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]])
+
+    def test_flushes_partial_chunk_at_deadline(self):
+        source = self.trickle([0, 0, 0.3, 0])
+        chunks = iter(Stream(source).chunk(10, max_wait=0.05))
+        start = time.perf_counter()
+        self.assertEqual(next(chunks), [0, 1])
+        self.assertLess(time.perf_counter() - start, 0.25)
+        self.assertEqual(list(chunks), [[2, 3]])
+
+    def test_blocked_source_does_not_hold_back_chunk(self):
+        release = threading.Event()
+
+        def source():
+            yield 1
+            yield 2
+            release.wait(5)
+            yield 3
+
+        chunks = iter(Stream(source()).chunk(5, max_wait=0.05))
+        self.assertEqual(next(chunks), [1, 2])
+        release.set()
+        self.assertEqual(next(chunks), [3])
+        with self.assertRaises(StopIteration):
+            next(chunks)
+
+    def test_source_error(self):
+        def source():
+            yield 1
+            raise KeyError("broken")
+
+        with self.assertRaises(KeyError):
+            Stream(source()).chunk(5, max_wait=0.05).to_list()
+
+    def test_empty_and_bad_arguments(self):
+        self.assertEqual(Stream([]).chunk(3, max_wait=0.1).to_list(), [])
+        with self.assertRaises(ValueError):
+            Stream.range(3).chunk(0, max_wait=0.1).to_list()
+        with self.assertRaises(ValueError):
+            Stream.range(3).chunk(3, max_wait=0).to_list()
+
+
+class FollowFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.directory.name) / "app.log"
+        self.path.write_text("a\nb\n")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def append(self, text):
+        with self.path.open("a") as file:
+            file.write(text)
+
+    def test_reads_appended_lines(self):
+        lines = iter(Stream.file(self.path, follow=True, poll_interval=0.01))
+        self.assertEqual([next(lines), next(lines)], ["a\n", "b\n"])
+        self.append("c\nd\n")
+        self.assertEqual([next(lines), next(lines)], ["c\n", "d\n"])
+        lines.close()
+
+    def test_waits_for_partial_line(self):
+        lines = iter(Stream.file(self.path, follow=True, poll_interval=0.01))
+        next(lines), next(lines)
+        self.append("par")
+        threading.Timer(0.05, self.append, ("tial\r\nnext\n",)).start()
+        self.assertEqual(next(lines), "partial\n")
+        self.assertEqual(next(lines), "next\n")
+        lines.close()
+
+    def test_rotation(self):
+        lines = iter(Stream.file(str(self.path), follow=True, poll_interval=0.01))
+        next(lines), next(lines)
+        self.append("old\n")
+        self.path.rename(self.path.with_suffix(".1"))
+        self.path.write_text("new\n")
+        self.assertEqual([next(lines), next(lines)], ["old\n", "new\n"])
+        lines.close()
+
+    def test_truncation(self):
+        lines = iter(Stream.file(self.path, follow=True, poll_interval=0.01))
+        next(lines), next(lines)
+        self.path.write_text("x\n")
+        self.assertEqual(next(lines), "x\n")
+        lines.close()
+
+    def test_file_closed_with_stream(self):
+        lines = iter(Stream.file(self.path, follow=True, poll_interval=0.01))
+        next(lines)
+        lines.close()
+        self.path.unlink()
+
+    def test_bad_arguments(self):
+        with self.assertRaises(ValueError):
+            Stream.file(self.path, follow=True, poll_interval=0)
+        compressed = pathlib.Path(self.directory.name) / "app.log.gz"
+        with gzip.open(compressed, "wt") as file:
+            file.write("a\n")
+        with self.assertRaises(ValueError):
+            Stream.file(compressed, follow=True)
+
+
+class FileTailTest(unittest.TestCase):
+    contents = [
+        "",
+        "a",
+        "a\n",
+        "a\nb",
+        "one\ntwo\n\nthree\r\nfour\n",
+        "x" * 70000 + "\ny\n",
+        "a\rb\rc",
+        "x\ny\r",
+        "\r\n\r\n",
+        "p\r\rq\r\n\nr",
+        "x" * 65535 + "\r\ny\r",
+    ]
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.directory.name) / "data.txt"
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, content):
+        self.path.write_bytes(content.encode())
+        return Stream(self.path.read_text().splitlines(keepends=True))
+
+    def test_size_and_last(self):
+        for content in self.contents:
+            expected = self.write(content)
+            self.assertEqual(Stream.file(self.path).size(), expected.size())
+            expected = self.write(content)
+            self.assertEqual(Stream.file(self.path).last(), expected.last())
+
+    def test_take_right(self):
+        for content in self.contents:
+            for count in (0, 1, 2, 10):
+                expected = self.write(content).take_right(count).to_list()
+                self.assertEqual(Stream.file(self.path).take_right(count).to_list(), expected)
+
+    def test_take_and_drop_right_while(self):
+        def predicate(line):
+            return len(line) < 5
+
+        for content in self.contents:
+            expected = self.write(content).take_right_while(predicate).to_list()
+            self.assertEqual(Stream.file(self.path).take_right_while(predicate).to_list(), expected)
+            expected = self.write(content).drop_right_while(predicate).to_list()
+            self.assertEqual(Stream.file(self.path).drop_right_while(predicate).to_list(), expected)
+
+    def test_carriage_returns_end_lines(self):
+        self.write("a\rb\rc")
+        self.assertEqual(Stream.file(self.path).size(), 3)
+        self.assertEqual(Stream.file(self.path).last(), "c")
+        self.assertEqual(Stream.file(self.path).drop_right_while(lambda line: True).to_list(), [])
+        self.write("x\ny\r")
+        self.assertEqual(Stream.file(self.path).take_right(2).to_list(), ["x\n", "y\n"])
+        self.write("a\r\nb\r\n")
+        self.assertEqual(Stream.file(self.path).size(), 2)
+        self.assertEqual(Stream.file(self.path).take_right(5).to_list(), ["a\n", "b\n"])
+
+    def test_reads_from_the_end(self):
+        self.write("".join(f"{i}\n" for i in range(100000)))
+        with patch("streampy._reversed_lines", wraps=functions._reversed_lines) as reversed_lines:
+            self.assertEqual(Stream.file(self.path).take_right(2).to_list(), ["99998\n", "99999\n"])
+            self.assertEqual(Stream.file(self.path).last(), "99999\n")
+        self.assertEqual(reversed_lines.call_count, 2)
+
+    def test_falls_back_after_operations(self):
+        self.write("a\nbb\nccc\n")
+        with patch("streampy._reversed_lines") as reversed_lines, patch("streampy._count_lines") as count_lines:
+            self.assertEqual(Stream.file(self.path).map(str.strip).last(), "ccc")
+            self.assertEqual(Stream.file(self.path).skip(1).size(), 2)
+            stream = Stream.file(self.path)
+            next(iter(stream))
+            self.assertEqual(stream.take_right(5).to_list(), ["bb\n", "ccc\n"])
+        reversed_lines.assert_not_called()
+        count_lines.assert_not_called()
@@ -0,0 +1,375 @@
+"""
+Transport of functions and batches between a parallel Stream and its process workers.
+
+Functions that pickle by reference (defined at the top level of an importable
+module) reach workers as usual. Lambdas, nested functions and closures cannot be
+imported by workers, nor can functions and classes of the __main__ module defined
+after the workers started, so `ship` serializes them by value: code, referenced globals,
+defaults and closure cells, recursively. Each stage is serialized once and workers
+cache the functions they load.
+
+When a process stage is given a shared memory threshold, batches are pickled with
+protocol 5 and every buffer of at least that many bytes travels out of band through
+a shared memory segment rather than through the pipe of the pool. That covers
+bytes, bytearray and memoryview items, also inside tuples and lists, and objects
+such as NumPy arrays whose pickling exposes out-of-band buffers. Workers read
+memoryview items and NumPy arrays straight from the segment, without a copy.
+"""
+import functools
+import importlib
+import io
+import marshal
+import pickle
+import sys
+import types
+from multiprocessing import shared_memory
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from compatibility import SHARED_MEMORY_TRACK
+
+DEFAULT_THRESHOLD = 1 << 16
+
+_BUFFERS = (bytes, bytearray, memoryview)
+
+# Input segments still mapped by a worker because its results kept views on them.
+_lingering: List[shared_memory.SharedMemory] = []
+
+
+class SharedPayload(NamedTuple):
+    """
+    A pickled object whose large buffers sit in a shared memory segment.
+    """
+
+    data: bytes
+    name: Optional[str]
+    sizes: Tuple[int, ...]
+
+
+class _Buffer:
+    def __init__(self, item: Any) -> None:
+        self.item = item
+
+    def __reduce__(self) -> Tuple[Callable, Tuple]:
+        view = memoryview(self.item)
+        return _rebuild, (type(self.item), pickle.PickleBuffer(view), view.format, view.shape)
+
+
+def _rebuild(kind: type, buffer: Any, format: str, shape: Tuple[int, ...]) -> Any:
+    if kind is memoryview:
+        return memoryview(buffer).cast("B").cast(format, shape)
+    return kind(buffer)
+
+
+def _wrap(item: Any, threshold: int) -> Any:
+    # bytes, bytearray and memoryview are pickled in band whatever the protocol:
+    # large ones are wrapped so that their content goes through a PickleBuffer.
+    if isinstance(item, _BUFFERS):
+        view = memoryview(item)
+        if view.nbytes >= threshold and view.c_contiguous:
+            return _Buffer(item)
+        return item
+    if type(item) in (list, tuple):
+        return type(item)(_wrap(element, threshold) for element in item)
+    return item
+
+
+def _segment(name: Optional[str] = None, size: int = 0, track: bool = True) -> Any:
+    # Before Python 3.13 every process registers the segments it creates or attaches
+    # with its resource tracker. Process pools start the tracker before their workers,
+    # see `pools`, so that all of them share the tracker of the Stream process and a
+    # segment stays registered once until the Stream process unlinks it.
+    if SHARED_MEMORY_TRACK:
+        return shared_memory.SharedMemory(name, create=name is None, size=size, track=track)
+    return shared_memory.SharedMemory(name, create=name is None, size=size)
+
+
+def share(obj: Any, threshold: int) -> Tuple[SharedPayload, Any]:
+    """
+    Pickle an object, moving its buffers of at least 'threshold' bytes to a new
+    shared memory segment.
+
+    Args:
+        obj: The object to pickle.
+        threshold: The size in bytes from which a buffer goes to shared memory.
+
+    Returns:
+        Tuple[SharedPayload, Any]: The payload, and the segment or None if no
+                                   buffer was large enough.
+    """
+    buffers = []
+
+    def collect(buffer):
+        # A true value keeps the buffer in band.
+        if buffer.raw().nbytes < threshold:
+            return True
+        buffers.append(buffer)
+        return False
+
+    # A plain callback rather than a method of a Pickler subclass: a bound method
+    # would tie the pickler, and the views held by its memo, into a reference cycle
+    # that keeps them alive, and with them the segment they point to, until a
+    # garbage collection.
+    file = io.BytesIO()
+    pickle.Pickler(file, protocol=5, buffer_callback=collect).dump(_wrap(obj, threshold))
+    if not buffers:
+        return SharedPayload(file.getvalue(), None, ()), None
+    raws = [buffer.raw() for buffer in buffers]
+    segment = _segment(size=sum(raw.nbytes for raw in raws))
+    offset = 0
+    for raw in raws:
+        segment.buf[offset : offset + raw.nbytes] = raw
+        offset += raw.nbytes
+    return SharedPayload(file.getvalue(), segment.name, tuple(raw.nbytes for raw in raws)), segment
+
+
+def release(segment: Any, *args: Any) -> None:
+    """
+    Close and unlink a segment created by `share`. Extra arguments are ignored, so
+    that it can be used as a future callback.
+
+    Args:
+        segment: The segment to release.
+    """
+    segment.close()
+    segment.unlink()
+
+
+def _views(segment: Any, sizes: Tuple[int, ...]) -> List[memoryview]:
+    views, offset = [], 0
+    for size in sizes:
+        views.append(segment.buf[offset : offset + size])
+        offset += size
+    return views
+
+
+def unshare(payload: Any) -> Any:
+    """
+    Load a payload built by `share` in a worker, copying its buffers out of the
+    segment, then unlink the segment. Other objects are returned unchanged.
+
+    Args:
+        payload: A SharedPayload, or any other object.
+
+    Returns:
+        Any: The loaded object.
+    """
+    if not isinstance(payload, SharedPayload):
+        return payload
+    if payload.name is None:
+        return pickle.loads(payload.data)
+    segment = _segment(payload.name)
+    try:
+        views = _views(segment, payload.sizes)
+        buffers = [bytearray(view) for view in views]
+        for view in views:
+            view.release()
+        return pickle.loads(payload.data, buffers=buffers)
+    finally:
+        release(segment)
+
+
+def discard(payload: Any) -> None:
+    """
+    Release the segment of a payload built by `share` in a worker without loading it,
+    for results that will never be collected.
+
+    Args:
+        payload: A SharedPayload, or any other object.
+    """
+    if isinstance(payload, SharedPayload) and payload.name is not None:
+        try:
+            segment = _segment(payload.name)
+        except FileNotFoundError:
+            return
+        release(segment)
+
+
+def run_shared(spec: Tuple[Callable, Any, int], payload: SharedPayload) -> SharedPayload:
+    """
+    Run a batch task in a worker on a payload built by `share`, and share its results
+    back the same way.
+
+    Args:
+        spec: The batch task, its function and the shared memory threshold.
+        payload: The batch.
+
+    Returns:
+        SharedPayload: The results of the task.
+    """
+    task, function, threshold = spec
+    # Segments failing to close again stay lingering until a later task.
+    lingering = _lingering[:]
+    _lingering.clear()
+    for segment in lingering:
+        _close(segment)
+    if payload.name is None:
+        return share(task(function, pickle.loads(payload.data)), threshold)[0]
+    segment = _segment(payload.name, track=False)
+    views = _views(segment, payload.sizes)
+    try:
+        results, segment_out = share(
+            task(function, pickle.loads(payload.data, buffers=views)), threshold
+        )
+        if segment_out is not None:
+            segment_out.close()
+        return results
+    finally:
+        del views
+        _close(segment)
+
+
+def _close(segment: Any) -> None:
+    try:
+        segment.close()
+    except BufferError:
+        _lingering.append(segment)
+
+
+class _Shipped:
+    def __init__(self, blob: bytes) -> None:
+        self.blob = blob
+
+    def __reduce__(self) -> Tuple[Callable, Tuple]:
+        return _unship, (self.blob,)
+
+
+@functools.lru_cache(maxsize=64)
+def _unship(blob: bytes) -> Any:
+    return pickle.loads(blob)
+
+
+def _importable(obj: Any) -> bool:
+    # Worker processes are forked once and live on, so the __main__ module they hold
+    # lacks whatever was defined in it since: what comes from it travels by value.
+    if obj.__module__ == "__main__":
+        return False
+    target = sys.modules.get(obj.__module__)
+    for name in obj.__qualname__.split("."):
+        target = getattr(target, name, None)
+    return target is obj
+
+
+def _global_names(code: types.CodeType) -> set:
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _global_names(const)
+    return names
+
+
+def _skeleton(code: bytes, name: str, cells: int) -> types.FunctionType:
+    closure = tuple(types.CellType() for _ in range(cells)) or None
+    return types.FunctionType(marshal.loads(code), {"__builtins__": __builtins__}, name, None, closure)
+
+
+def _fill(function: types.FunctionType, state: Dict[str, Any]) -> None:
+    function.__globals__.update(state["globals"])
+    function.__defaults__ = state["defaults"]
+    function.__kwdefaults__ = state["kwdefaults"]
+    function.__dict__.update(state["dict"])
+    function.__module__ = state["module"]
+    function.__qualname__ = state["qualname"]
+    for cell, value in zip(function.__closure__ or (), state["cells"]):
+        if value is not _EMPTY_CELL:
+            cell.cell_contents = value
+
+
+def _class_skeleton(metaclass: type, name: str, bases: Tuple[type, ...], slots: Any) -> type:
+    namespace = {} if slots is None else {"__slots__": slots}
+    return types.new_class(name, bases, {"metaclass": metaclass}, lambda ns: ns.update(namespace))
+
+
+def _fill_class(cls: type, state: Dict[str, Any]) -> None:
+    for name, value in state.items():
+        setattr(cls, name, value)
+
+
+class _EmptyCell:
+    def __reduce__(self) -> str:
+        return "_EMPTY_CELL"
+
+
+_EMPTY_CELL = _EmptyCell()
+
+
+def _cell_contents(cell: types.CellType) -> Any:
+    try:
+        return cell.cell_contents
+    except ValueError:
+        return _EMPTY_CELL
+
+
+class _FunctionPickler(pickle.Pickler):
+    # Set once something had to be serialized by value.
+    by_value = False
+
+    def reducer_override(self, obj: Any) -> Any:
+        if isinstance(obj, types.ModuleType):
+            self.by_value = True
+            return importlib.import_module, (obj.__name__,)
+        if isinstance(obj, type) and not _importable(obj):
+            self.by_value = True
+            return self.reduce_class(obj)
+        if not isinstance(obj, types.FunctionType) or _importable(obj):
+            return NotImplemented
+        self.by_value = True
+        code = obj.__code__
+        state = {
+            "globals": {
+                name: obj.__globals__[name]
+                for name in _global_names(code)
+                if name in obj.__globals__
+            },
+            "defaults": obj.__defaults__,
+            "kwdefaults": obj.__kwdefaults__,
+            "dict": obj.__dict__,
+            "module": obj.__module__,
+            "qualname": obj.__qualname__,
+            "cells": [_cell_contents(cell) for cell in obj.__closure__ or ()],
+        }
+        # The skeleton is memoized before its state is pickled, so recursive
+        # functions refer back to it instead of recursing forever.
+        skeleton_args = (marshal.dumps(code), obj.__name__, len(obj.__closure__ or ()))
+        return _skeleton, skeleton_args, state, None, None, _fill
+
+    def reduce_class(self, cls: type) -> Tuple:
+        # Like functions, the class is memoized before its attributes are pickled,
+        # so that methods referring to their class find it.
+        slots = cls.__dict__.get("__slots__")
+        state = {
+            name: value
+            for name, value in cls.__dict__.items()
+            if name not in ("__dict__", "__weakref__", "__slots__")
+            and not isinstance(value, (types.MemberDescriptorType, types.GetSetDescriptorType))
+        }
+        skeleton_args = (type(cls), cls.__name__, cls.__bases__, slots)
+        return _class_skeleton, skeleton_args, state, None, None, _fill_class
+
+
+def ship(obj: Any) -> Any:
+    """
+    Prepare a function, or an object holding functions, to be sent to process workers.
+
+    Objects that pickle as usual are returned unchanged. Objects holding lambdas,
+    nested functions, or functions and classes of the __main__ module are serialized
+    by value once, and the result unpickles to an equivalent object in the workers.
+
+    Args:
+        obj: The function or object to send.
+
+    Raises:
+        TypeError: If the object holds something that cannot be serialized even by
+                   value, such as a lock, an open file or a generator.
+
+    Returns:
+        Any: An object to pickle in place of 'obj'.
+    """
+    file = io.BytesIO()
+    pickler = _FunctionPickler(file, pickle.HIGHEST_PROTOCOL)
+    try:
+        pickler.dump(obj)
+    except Exception as error:
+        raise TypeError(f"Cannot ship {obj!r} to process workers: {error}") from error
+    if not pickler.by_value:
+        return obj
+    return _Shipped(file.getvalue())